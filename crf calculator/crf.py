@@ -1,6 +1,25 @@
-import pandas as pd
+import os
+import sys
+import time
+import threading
+import numpy as np
 import sqlite3
 
+#donor database shipped with the module
+DEFAULT_DB = 'ten_k_donors.db'
+
+#donor database layout
+DONOR_TABLE = 'donors'
+BLOOD_GROUP = 'BG'
+#column of unacceptable antigen lists in a batch of recipients
+UNACCEPTABLE = 'UA'
+#columns in the donor table that are not antigens
+NON_ANTIGEN_COLUMNS = ('index', BLOOD_GROUP)
+
+#pandas (and the process pool) are only imported when used, so the cRF
+#engine loads with numpy alone
+
+
 def compatible_blood_groups(bg: str):
     '''
     return a list of compatible blood groups
@@ -20,32 +39,428 @@ def compatible_blood_groups(bg: str):
     return compatible[bg]
 
 
-def get_donors(db='ten_k_donors.db'):
+def get_donors(db=DEFAULT_DB):
     '''
     read the donor type info from the database
     '''
+    import pandas as pd
     with sqlite3.connect(db) as con:
         donors = pd.read_sql_query('select * from donors', con=con)
     return donors
 
 
-def crf_cal(bg: str, ua: list):
+class CRF_Engine:
+    '''
+    Donor HLA types held as bitsets for fast cRF calculation.
+
+    Every antigen and every blood group is a python int with bit n set
+    when donor n carries that antigen / has that blood group. A cRF is
+    then the OR of the unacceptable antigen bitsets, AND the compatible
+    blood group bitset, and a popcount.
+
+    Parameters
+    ----------
+    blood_groups : blood group of each donor
+    antigens     : antigen names (columns of flags)
+    flags        : donors x antigens array like, 1 = donor carries antigen
+
+    Examples
+    --------
+    >>> engine = CRF_Engine.from_db('ten_k_donors.db')
+    >>> engine.crf('A', ['A2', 'A3', 'DR7', 'DQ1'])
+    0.9212163096060816
+    >>> engine.crf_batch([('A', ['A2', 'A3']), ('O', ['B8', 'DR17'])])
+    array([...])
+    >>> engine.what_if('A', ['A2', 'A3', 'DR7', 'DQ1'])
+    {'A1': 0.0513..., 'A203': 0.0, ...}
+    '''
+
+    def __init__(self, blood_groups, antigens, flags):
+        flags = np.asarray(flags) == 1
+        blood_groups = np.asarray([str(x).upper() for x in blood_groups])
+        if flags.shape != (len(blood_groups), len(antigens)):
+            raise ValueError(f'flags shape {flags.shape} does not match '
+                             f'{len(blood_groups)} donors x '
+                             f'{len(antigens)} antigens')
+
+        self.antigens = [x.upper() for x in antigens]
+        self.donor_count = len(blood_groups)
+
+        #one bitset per antigen
+        self.__antigens = dict(zip(self.antigens, self.__to_bitsets(flags.T)))
+
+        #one bitset (and donor count) per recipient blood group,
+        #covering all of the donor blood groups compatible with it
+        groups = ['A', 'AB', 'B', 'O']
+        donor_groups = dict(zip(groups, self.__to_bitsets(
+            np.array([blood_groups == x for x in groups]))))
+        self.__blood_groups = {}
+        for bg in groups:
+            mask = 0
+            for x in compatible_blood_groups(bg):
+                mask |= donor_groups[x]
+            self.__blood_groups[bg] = (mask, mask.bit_count())
+
+        #dense matrices for calculating many recipients at once
+        #antigens x donors, and recipient blood group x donors
+        self.__antigen_index = {x: n for n, x in enumerate(self.antigens)}
+        self.__donor_antigens = flags.T.astype(np.float32)
+        self.__group_index = {x: n for n, x in enumerate(groups)}
+        self.__compatible = np.array([np.isin(blood_groups,
+                                              compatible_blood_groups(x))
+                                      for x in groups])
+        self.__compatible_count = self.__compatible.sum(axis=1)
+
+        #donor blood groups, for the incidence tables (built on first use)
+        self.__donor_groups = blood_groups
+        self.__incidence = None
+
+
+    @classmethod
+    def from_db(cls, db=DEFAULT_DB):
+        '''
+        load the donors table straight from the database
+        '''
+        with sqlite3.connect(db) as con:
+            cursor = con.execute(f'select * from {DONOR_TABLE}')
+            columns = [x[0] for x in cursor.description]
+            rows = cursor.fetchall()
+
+        data = np.array(rows, dtype=object).reshape(len(rows), len(columns))
+        antigens = [n for n, x in enumerate(columns)
+                    if x not in NON_ANTIGEN_COLUMNS]
+        #missing flags (NULL) count as not carrying the antigen
+        flags = np.nan_to_num(data[:, antigens].astype(float))
+
+        return cls(data[:, columns.index(BLOOD_GROUP)],
+                   [columns[n] for n in antigens],
+                   flags)
+
+
+    def antigen_bitset(self, ua: list):
+        '''
+        OR of the bitsets of the given antigens
+        '''
+        bits = 0
+        for x in ua:
+            try:
+                bits |= self.__antigens[x.upper()]
+            except KeyError:
+                raise ValueError(f'{x} is not a valid antigen!') from None
+        return bits
+
+
+    def crf(self, bg: str, ua: list):
+        '''
+        calculate crf based on the given blood group:bg
+        and list of unacceptable antigens:ua
+        '''
+        try:
+            mask, total = self.__blood_groups[bg.upper()]
+        except KeyError:
+            raise ValueError(f'{bg} is not a valid blood group!') from None
+        return (self.antigen_bitset(ua) & mask).bit_count() / total
+
+
+    def crf_batch(self, recipients, chunk_size=1000, processes=None):
+        '''
+        calculate the crf of many recipients in one go
+        recipients: a list of (blood group, unacceptable antigens) pairs
+                    or a dataframe with BG and UA columns
+        recipients are processed in chunks of chunk_size, spread over
+        worker processes if processes > 1
+        return a numpy array with the crf of each recipient in order
+        '''
+        #a dataframe can only be passed in if pandas is already imported
+        pd = sys.modules.get('pandas')
+        if pd is not None and isinstance(recipients, pd.DataFrame):
+            recipients = zip(recipients[BLOOD_GROUP], recipients[UNACCEPTABLE])
+        recipients = list(recipients)
+
+        chunks = [recipients[n:n + chunk_size]
+                  for n in range(0, len(recipients), chunk_size)]
+
+        if not chunks:
+            return np.zeros(0)
+        if processes is None or processes < 2 or len(chunks) < 2:
+            return np.concatenate([self.crf_chunk(x) for x in chunks])
+
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_set_batch_engine,
+                                 initargs=(self,)) as pool:
+            return np.concatenate(list(pool.map(_batch_engine_chunk, chunks)))
+
+
+    def crf_chunk(self, recipients):
+        '''
+        crf of a list of (blood group, unacceptable antigens) pairs as a
+        single matrix product: the recipient x antigen indicator matrix
+        times the antigen x donor matrix counts each donor's unacceptable
+        antigens, masked by the donors compatible with each blood group
+        '''
+        groups, unacceptable = self.__indicators(recipients)
+
+        incompatible = (unacceptable @ self.__donor_antigens) > 0
+        incompatible &= self.__compatible[groups]
+
+        return incompatible.sum(axis=1) / self.__compatible_count[groups]
+
+
+    def what_if(self, bg: str, ua: list):
+        '''
+        the increase in crf from adding each other antigen to the
+        unacceptable antigens:ua of a recipient with blood group:bg
+        all candidates are counted in one matrix product over the donors
+        that are still compatible
+        return a dictionary of antigen: crf increase
+        '''
+        groups, unacceptable = self.__indicators([(bg, ua)])
+
+        acceptable = self.__compatible[groups[0]] & \
+            ~((unacceptable[0] @ self.__donor_antigens) > 0)
+        increase = (self.__donor_antigens @ acceptable.astype(np.float32)) / \
+            self.__compatible_count[groups[0]]
+
+        return {x: float(v) for x, v, u in
+                zip(self.antigens, increase, unacceptable[0]) if not u}
+
+
+    def incidence(self):
+        '''
+        donor incidence tables, built once per engine (i.e. donor file)
+        return a dictionary of donor blood group: {
+            'donors'   : number of donors with the blood group
+            'antigens' : number of those donors carrying each antigen
+            'pairs'    : antigens x antigens numbers of those donors
+                         carrying both antigens (diagonal = 'antigens')}
+        rows/columns follow the order of CRF_Engine.antigens
+        '''
+        if self.__incidence is None:
+            incidence = {}
+            for bg in self.__group_index:
+                d = self.__donor_antigens[:, self.__donor_groups == bg]
+                pairs = (d @ d.T).astype(np.int64)
+                incidence[bg] = {'donors': d.shape[1],
+                                 'antigens': pairs.diagonal().copy(),
+                                 'pairs': pairs}
+            self.__incidence = incidence
+        return self.__incidence
+
+
+    def __indicators(self, recipients):
+        '''
+        blood group number and unacceptable antigen indicator row
+        (float32, 1 = unacceptable) of each recipient
+        '''
+        groups = np.empty(len(recipients), dtype=np.intp)
+        unacceptable = np.zeros((len(recipients), len(self.antigens)),
+                                dtype=np.float32)
+        for n, (bg, ua) in enumerate(recipients):
+            try:
+                groups[n] = self.__group_index[bg.upper()]
+            except KeyError:
+                raise ValueError(f'{bg} is not a valid blood group!') from None
+            for x in ua:
+                try:
+                    unacceptable[n, self.__antigen_index[x.upper()]] = 1
+                except KeyError:
+                    raise ValueError(f'{x} is not a valid antigen!') from None
+        return groups, unacceptable
+
+
+    def __to_bitsets(self, rows):
+        '''
+        pack each row of a boolean array into a python int (bit n = column n)
+        '''
+        packed = np.packbits(rows, axis=1, bitorder='little')
+        return [int.from_bytes(x.tobytes(), 'little') for x in packed]
+
+
+#engine of the worker processes of CRF_Engine.crf_batch
+_batch_engine = None
+
+
+def _set_batch_engine(engine):
+    '''
+    worker initialiser: the engine is sent once per process
+    '''
+    global _batch_engine
+    _batch_engine = engine
+
+
+def _batch_engine_chunk(recipients):
+    return _batch_engine.crf_chunk(recipients)
+
+
+class DonorPool:
+    '''
+    The donors of one database held in memory as a CRF_Engine.
+
+    The database file is checked for changes (modification time and size)
+    at most every check_interval seconds; a changed file is loaded into a
+    new engine which then replaces the old one in a single assignment, so
+    callers keep using the old donors until the new ones are ready and are
+    never blocked by a reload. If a reload fails (e.g. the file is being
+    copied over) the current donors stay in service and the file is tried
+    again at the next check. Several pools (e.g. different ODT releases)
+    can be used side by side.
+
+    Examples
+    --------
+    >>> pool = DonorPool('ten_k_donors.db')
+    >>> pool.crf('A', ['A2', 'A3', 'DR7', 'DQ1'])
+    0.9212163096060816
+    >>> new_pool = DonorPool('new_donors.db')
+    '''
+
+    def __init__(self, db=DEFAULT_DB, check_interval=1.0):
+        if not os.path.exists(db):
+            raise FileNotFoundError(f"The file '{db}' cannot be found!")
+        #absolute, so a later change of working directory checks the same file
+        self.db = os.path.abspath(db)
+        self.check_interval = check_interval
+        self.__lock = threading.Lock()
+        self.__checked = 0
+        self.__stamp = None
+        self.__engine = None
+        self.reload()
+
+
+    @property
+    def engine(self):
+        '''
+        the current CRF_Engine, reloaded first if the database has changed
+        '''
+        self.check()
+        return self.__engine
+
+
+    @property
+    def current_engine(self):
+        '''
+        the CRF_Engine in service now, without checking the database
+        '''
+        return self.__engine
+
+
+    def check(self):
+        '''
+        reload the donors if check_interval has passed since the last
+        check and the database has changed
+        return True if new donors were loaded
+        '''
+        now = time.monotonic()
+        if now - self.__checked < self.check_interval:
+            return False
+        self.__checked = now
+        try:
+            changed = self.__file_stamp() != self.__stamp
+        except OSError as err:
+            #e.g. the file is being replaced, check again next time
+            print(f"Unable to check donors in '{self.db}':", err)
+            return False
+        return self.reload() if changed else False
+
+
+    def reload(self, force=False):
+        '''
+        load the donors again if the database has changed (or force = True)
+        only one thread reloads at a time, the others carry on with the
+        current engine. If donors are already loaded a failed reload keeps
+        them in service (the error is printed) and the next check retries.
+        return True if new donors were loaded
+        '''
+        if not self.__lock.acquire(blocking=self.__engine is None):
+            return False
+        try:
+            try:
+                stamp = self.__file_stamp()
+                if not force and stamp == self.__stamp:
+                    return False
+                engine = CRF_Engine.from_db(self.db)
+            except (OSError, sqlite3.Error) as err:
+                if self.__engine is None:
+                    raise
+                print(f"Unable to reload donors from '{self.db}':", err)
+                return False
+            #swap in the fully built engine
+            self.__engine, self.__stamp = engine, stamp
+            return True
+        finally:
+            self.__lock.release()
+
+
+    def crf(self, bg: str, ua: list):
+        '''
+        calculate crf based on the given blood group:bg
+        and list of unacceptable antigens:ua
+        '''
+        return self.engine.crf(bg, ua)
+
+
+    def crf_batch(self, recipients, chunk_size=1000, processes=None):
+        '''
+        calculate crf for many recipients at once, see CRF_Engine.crf_batch
+        '''
+        return self.engine.crf_batch(recipients, chunk_size=chunk_size,
+                                     processes=processes)
+
+
+    def what_if(self, bg: str, ua: list):
+        '''
+        crf increase for each additional antigen, see CRF_Engine.what_if
+        '''
+        return self.engine.what_if(bg, ua)
+
+
+    def __file_stamp(self):
+        stat = os.stat(self.db)
+        return stat.st_mtime_ns, stat.st_size
+
+
+#pools already loaded, by database
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db=DEFAULT_DB):
+    '''
+    the shared DonorPool of the given database, created on first use
+    '''
+    key = os.path.abspath(db)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = DonorPool(db)
+    return pool
+
+
+def crf_cal(bg: str, ua: list, db=DEFAULT_DB):
     '''
     calculate crf based on the given blood group:bg
     and list of unacceptable antigens:ua
+    using the donors in the database:db
     '''
-    #read the database
-    donors = get_donors()
-    #get donor with the compatible blood groups
-    comp_bg = compatible_blood_groups(bg)
-    comp_donors = donors[donors.BG.isin(comp_bg)]
-    #donor with unacceptable antigens
-    query = ' or '.join([f'{x}==1' for x in ua])
-    comp = len(comp_donors.query(query))
-    #total compatible donors
-    total = len(comp_donors)
-    return comp / total
+    return get_pool(db).crf(bg, ua)
 
 
+def crf_cal_batch(recipients, chunk_size=1000, processes=None, db=DEFAULT_DB):
+    '''
+    calculate crf for many recipients at once
+    recipients: a list of (blood group, unacceptable antigens) pairs
+                or a dataframe with BG and UA columns
+    '''
+    return get_pool(db).crf_batch(recipients, chunk_size=chunk_size,
+                                  processes=processes)
 
 
+def crf_what_if(bg: str, ua: list, db=DEFAULT_DB):
+    '''
+    the increase in crf from adding each other antigen to the
+    unacceptable antigens:ua of a recipient with blood group:bg
+    return a dictionary of antigen: crf increase
+    '''
+    return get_pool(db).what_if(bg, ua)
@@ -0,0 +1,317 @@
+'''
+Small local HTTP/JSON service for cRF calculations
+
+    $python crf_service.py --port 8080 --db ten_k_donors.db
+
+POST /crf        {"bg": "A", "ua": ["A2", "A3", "DR7", "DQ1"]}
+                 -> {"crf": 0.9212163096060816}
+POST /crf/batch  {"recipients": [{"bg": "A", "ua": ["A2"]}, ...]}
+                 -> {"crf": [0.5009214466712739, ...]}
+GET  /stats      -> request, latency and cache counters
+
+Results are cached (LRU) by blood group and the sorted, upper case set of
+unacceptable antigens, so the same recipient asked again with the
+antigens in another order or case is served from the cache. Identical
+requests arriving while one is being calculated wait for that result
+instead of calculating it again. The donor database is checked for
+changes in the background, off the event loop; once the pool has loaded
+new donors the cache is emptied and results still being calculated on
+the old donors are not cached.
+'''
+import json
+import time
+import asyncio
+import argparse
+from collections import OrderedDict
+from crf import DEFAULT_DB, get_pool
+
+#number of results kept in the cache
+CACHE_SIZE = 100000
+
+#shortest time between checks of the donor database by the service
+MIN_CHECK_INTERVAL = 0.1
+
+#largest request body accepted
+MAX_BODY = 16 * 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+def normalise(bg: str, ua: list):
+    '''
+    cache key of a recipient: upper case blood group and the sorted,
+    upper case unique unacceptable antigens
+    '''
+    return (bg.strip().upper(),
+            tuple(sorted({x.strip().upper() for x in ua})))
+
+
+class CRF_Service:
+    '''
+    cRF calculations of a DonorPool with result caching and request
+    coalescing, served over HTTP by serve()
+
+    Examples
+    --------
+    >>> service = CRF_Service(get_pool('ten_k_donors.db'))
+    >>> asyncio.run(service.serve('127.0.0.1', 8080))
+    '''
+
+    def __init__(self, pool, cache_size=CACHE_SIZE):
+        self.pool = pool
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__in_flight = {}
+        self.__engine = None
+        self.__counters = {'requests': 0,
+                           'errors': 0,
+                           'cache_hits': 0,
+                           'cache_misses': 0,
+                           'coalesced': 0,
+                           'total_latency_ms': 0.0,
+                           'max_latency_ms': 0.0}
+
+
+    ###Calculations###
+    async def crf(self, bg: str, ua: list):
+        '''
+        crf of one recipient, from the cache if possible
+        '''
+        engine = self.__current_engine()
+        key = normalise(bg, ua)
+
+        value = self.__cache_get(key)
+        if value is not None:
+            return value
+
+        #the same recipient is already being calculated on these donors
+        if key in self.__in_flight:
+            self.__counters['coalesced'] += 1
+            return await asyncio.shield(self.__in_flight[key])
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, engine.crf, key[0], list(key[1]))
+        self.__in_flight[key] = future
+        try:
+            value = await future
+        finally:
+            #unless the donors changed meanwhile and it was dropped
+            if self.__in_flight.get(key) is future:
+                del self.__in_flight[key]
+
+        self.__cache_put(key, value, engine)
+        return value
+
+
+    async def crf_batch(self, recipients):
+        '''
+        crf of a list of (bg, ua) pairs; the ones not in the cache are
+        calculated together in one batch
+        '''
+        engine = self.__current_engine()
+        keys = [normalise(bg, ua) for bg, ua in recipients]
+
+        values = [self.__cache_get(key) for key in keys]
+        missing = list(OrderedDict.fromkeys(
+            key for key, value in zip(keys, values) if value is None))
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            calculated = await loop.run_in_executor(
+                None, engine.crf_batch, [(bg, list(ua)) for bg, ua in missing])
+            calculated = dict(zip(missing, calculated.tolist()))
+            for key, value in calculated.items():
+                self.__cache_put(key, value, engine)
+            values = [calculated[key] if value is None else value
+                      for key, value in zip(keys, values)]
+
+        return values
+
+
+    def stats(self):
+        '''
+        request, latency and cache counters
+        '''
+        stats = dict(self.__counters)
+        lookups = stats['cache_hits'] + stats['cache_misses']
+        stats['cache_hit_rate'] = stats['cache_hits'] / lookups if lookups else 0.0
+        stats['mean_latency_ms'] = (stats['total_latency_ms'] / stats['requests']
+                                    if stats['requests'] else 0.0)
+        stats['cache_entries'] = len(self.__cache)
+        return stats
+
+
+    ###HTTP###
+    async def serve(self, host='127.0.0.1', port=8080):
+        '''
+        serve the calculations over HTTP until cancelled
+        '''
+        server = await asyncio.start_server(self.handle, host, port)
+        watcher = asyncio.create_task(self.watch_pool())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+
+    async def watch_pool(self):
+        '''
+        check the donor database for changes every check_interval seconds
+        in the executor, so loading new donors never blocks the event loop
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(max(self.pool.check_interval, MIN_CHECK_INTERVAL))
+            try:
+                await loop.run_in_executor(None, self.pool.check)
+            except Exception as err:
+                print('Unable to check the donor database:', err)
+
+
+    async def handle(self, reader, writer):
+        '''
+        handle the (keep-alive) HTTP requests of one connection
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    await self.__respond(writer, 413, {'error': 'request too large'},
+                                         close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                start = time.perf_counter()
+                status, result = await self.__route(method, path, body)
+                self.__count_request(status, time.perf_counter() - start)
+
+                close = headers.get('connection', '').lower() == 'close'
+                await self.__respond(writer, status, result, close=close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def __route(self, method, path, body):
+        '''
+        run the request, return the HTTP status and the json result
+        '''
+        path = path.split('?', 1)[0].rstrip('/')
+        routes = {'/crf': ('POST', self.__post_crf),
+                  '/crf/batch': ('POST', self.__post_crf_batch),
+                  '/stats': ('GET', self.__get_stats)}
+        if path not in routes:
+            return 404, {'error': f'{path} not found'}
+        if method != routes[path][0]:
+            return 405, {'error': f'use {routes[path][0]} for {path}'}
+
+        try:
+            data = json.loads(body) if body else {}
+            return 200, await routes[path][1](data)
+        except KeyError as err:
+            return 400, {'error': f'missing {err}'}
+        except (ValueError, TypeError, AttributeError) as err:
+            return 400, {'error': str(err)}
+        except Exception as err:
+            return 500, {'error': str(err)}
+
+
+    async def __post_crf(self, data):
+        return {'crf': await self.crf(data['bg'], data['ua'])}
+
+
+    async def __post_crf_batch(self, data):
+        recipients = [(x['bg'], x['ua']) for x in data['recipients']]
+        return {'crf': await self.crf_batch(recipients)}
+
+
+    async def __get_stats(self, data):
+        return self.stats()
+
+
+    async def __respond(self, writer, status, result, close=False):
+        body = json.dumps(result).encode('utf-8')
+        head = (f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"close" if close else "keep-alive"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+    ###Cache###
+    def __current_engine(self):
+        '''
+        the pool's engine, without checking the database (see watch_pool);
+        cached and in flight results are dropped when it changes
+        '''
+        engine = self.pool.current_engine
+        if engine is not self.__engine:
+            self.__cache.clear()
+            self.__in_flight.clear()
+            self.__engine = engine
+        return engine
+
+
+    def __cache_get(self, key):
+        value = self.__cache.get(key)
+        if value is None:
+            self.__counters['cache_misses'] += 1
+        else:
+            self.__counters['cache_hits'] += 1
+            self.__cache.move_to_end(key)
+        return value
+
+
+    def __cache_put(self, key, value, engine):
+        #a result of donors replaced while it was calculated is not kept
+        if engine is not self.__current_engine():
+            return
+        self.__cache[key] = value
+        self.__cache.move_to_end(key)
+        while len(self.__cache) > self.cache_size:
+            self.__cache.popitem(last=False)
+
+
+    def __count_request(self, status, seconds):
+        ms = seconds * 1000
+        self.__counters['requests'] += 1
+        if status != 200:
+            self.__counters['errors'] += 1
+        self.__counters['total_latency_ms'] += ms
+        self.__counters['max_latency_ms'] = max(self.__counters['max_latency_ms'], ms)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local cRF HTTP service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--db', default=DEFAULT_DB)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+
+    service = CRF_Service(get_pool(args.db), cache_size=args.cache_size)
+    print(f'\n\tServing cRF on http://{args.host}:{args.port}/crf ...\n')
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -1,49 +1,187 @@
 from pyxlsb import open_workbook
-import pandas as pd
-import io
+import os
+import re
+import hashlib
 import sqlite3
+import tempfile
+from datetime import datetime
 import requests
 
 
 URL = 'https://nhsbtdbe.blob.core.windows.net/umbraco-assets-corp/5948/hla-mm-and-crf.xlsb'
 
-def read_crf_xlsb(xlsb_file):
+#donors written to the database per executemany call
+CHUNK_SIZE = 1000
+
+#the donors of every converted version are kept in their own table
+#'donors' is a view of the latest one, as read by crf.py
+DONOR_VIEW = 'donors'
+VERSION_TABLE = 'donor_versions'
+#version name of a donors table written before versioning
+LEGACY_VERSION = 'legacy'
+
+
+def iter_crf_xlsb(xlsb_file):
     '''
-    read the crf calculator file from odt and convert it to a pandas dataframe
+    stream the donor sheet of the crf calculator file from odt row by row
+    yield the (upper case) column names first, then one list per donor:
+    blood group followed by the antigen flags as 0/1 integers
     '''
-    data = []
     with open_workbook(xlsb_file) as wb:
         #get the sheet with donor types (hopefully only 1)
         donor = [s for s in wb.sheets if 'Donor' in s][0]
         #open the donor type sheet
         with wb.get_sheet(donor) as sheet:
+            rows = sheet.rows()
             #find the header
-            header = [x.v for x in next(sheet.rows())]
+            header = [x.v for x in next(rows)]
             #find the begining and the end of HLA type with Blood Group in front
             #assuming the first 'BG' and 'DQ4' are start and finish
-            column_range = [header.index(x) for x in header if 'BG' in x or 'DQ4' in x][:2]
+            column_range = [n for n, x in enumerate(header) if isinstance(x, str)
+                            and ('BG' in x or 'DQ4' in x)][:2]
             if len(column_range) != 2 or (column_range[1] - column_range[0] <= 0):
                 raise Exception('Input xlsb seems to be in an unrecognisable format!')
-            
-            for row in sheet.rows():
-                data.append([x.v for x in row[column_range[0]:column_range[1] + 1]])
-    df = pd.DataFrame(data, dtype=int)
-    df.rename(columns=df.iloc[0].apply(lambda x:x.upper()), inplace=True)
-    df.drop(df.index[0], inplace=True)
-    df.fillna(0, inplace=True)
+            start, end = column_range[0], column_range[1] + 1
+
+            yield [x.upper() for x in header[start:end]]
+
+            for row in rows:
+                values = [x.v for x in row[start:end]]
+                #skip empty rows
+                if not values or values[0] is None:
+                    continue
+                yield [values[0]] + [int(x) if x else 0 for x in values[1:]]
+
+
+def read_crf_xlsb(xlsb_file):
+    '''
+    read the crf calculator file from odt and convert it to a pandas dataframe
+    '''
+    import pandas as pd
+    rows = iter_crf_xlsb(xlsb_file)
+    header = next(rows)
+    df = pd.DataFrame(list(rows), columns=header)
+    df.index += 1
     return df
 
-def crf_xlsb_to_db(url=URL, db='ten_k_donors.db'):
+
+def write_donors(rows, db='ten_k_donors.db', version='latest',
+                 source='', chunk_size=CHUNK_SIZE):
+    '''
+    write the donors from rows (column names first, as iter_crf_xlsb)
+    into the table 'donors_<version>' and point the 'donors' view at it
+
+    everything is written in one transaction, chunk_size donors at a time,
+    so memory use does not grow with the number of donors and a failed
+    conversion leaves the database as it was. Converting the same version
+    again replaces its donors in place. Antigen flags are stored as
+    INTEGER 0/1, which sqlite keeps without any payload bytes
+    a 'donors' table from before versioning is renamed (keep_legacy_donors),
+    never dropped
+    '''
+    header = next(rows)
+    table = 'donors_' + re.sub(r'\W', '_', str(version))
+
+    columns = ['"index" INTEGER PRIMARY KEY', f'"{header[0]}" TEXT']
+    columns += [f'"{x}" INTEGER NOT NULL DEFAULT 0' for x in header[1:]]
+    insert = (f'INSERT OR REPLACE INTO "{table}" VALUES '
+              f'({", ".join("?" * (len(header) + 1))})')
+
+    con = sqlite3.connect(db, isolation_level=None)
+    try:
+        con.execute('BEGIN')
+
+        con.execute(f'CREATE TABLE IF NOT EXISTS "{VERSION_TABLE}" ('
+                    'version TEXT PRIMARY KEY, donor_table TEXT, '
+                    'source TEXT, donor_count INTEGER, converted TEXT)')
+
+        #a donors table from before versioning is kept as a version of its own
+        old = con.execute('SELECT type FROM sqlite_master WHERE name = ?',
+                          (DONOR_VIEW,)).fetchone()
+        if old and old[0] == 'table':
+            keep_legacy_donors(con)
+
+        con.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({", ".join(columns)})')
+        con.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{header[0]}" '
+                    f'ON "{table}" ("{header[0]}")')
+
+        count = 0
+        chunk = []
+        for count, row in enumerate(rows, 1):
+            chunk.append([count] + list(row))
+            if len(chunk) == chunk_size:
+                con.executemany(insert, chunk)
+                chunk = []
+        if chunk:
+            con.executemany(insert, chunk)
+        #donors left over from a longer earlier conversion of this version
+        con.execute(f'DELETE FROM "{table}" WHERE "index" > ?', (count,))
+
+        #point the donors view at this version
+        con.execute(f'DROP VIEW IF EXISTS "{DONOR_VIEW}"')
+        con.execute(f'CREATE VIEW "{DONOR_VIEW}" AS SELECT * FROM "{table}"')
+
+        con.execute(f'INSERT OR REPLACE INTO "{VERSION_TABLE}" '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (str(version), table, source, count,
+                     datetime.now().isoformat(timespec='seconds')))
+
+        con.execute('COMMIT')
+    except BaseException:
+        con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+
+    return count
+
+
+def keep_legacy_donors(con):
     '''
-    output the converted dataframe to the donor database
+    rename a donors table written before versioning to LEGACY_VERSION's
+    table and record it in the version table, so it is not lost and can
+    be pointed back to; run within the conversion transaction
     '''
-    #create download connection
-    dl = requests.get(url)
-    #download the file, convert to byte stream then dataframe
-    df = read_crf_xlsb(io.BytesIO(dl.content))
-    #output to database
-    con = sqlite3.connect(db)
-    df.to_sql(con=con, name='donors')
+    table = 'donors_' + LEGACY_VERSION
+    n = 1
+    while con.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+                      (table,)).fetchone():
+        n += 1
+        table = f'donors_{LEGACY_VERSION}_{n}'
+    version = table[len('donors_'):]
+
+    con.execute(f'ALTER TABLE "{DONOR_VIEW}" RENAME TO "{table}"')
+    count = con.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    con.execute(f'INSERT OR REPLACE INTO "{VERSION_TABLE}" '
+                'VALUES (?, ?, ?, ?, ?)',
+                (version, table, 'donors table before versioning', count,
+                 datetime.now().isoformat(timespec='seconds')))
+    return table
+
+
+def crf_xlsb_to_db(url=URL, db='ten_k_donors.db', version=None):
+    '''
+    output the converted donors to the donor database
+    version defaults to the start of the sha1 of the downloaded file
+    '''
+    #stream the download to a temporary file
+    fd, xlsb_file = tempfile.mkstemp(suffix='.xlsb')
+    try:
+        sha1 = hashlib.sha1()
+        with os.fdopen(fd, 'wb') as fout, requests.get(url, stream=True) as dl:
+            dl.raise_for_status()
+            for chunk in dl.iter_content(chunk_size=1 << 16):
+                sha1.update(chunk)
+                fout.write(chunk)
+
+        if version is None:
+            version = sha1.hexdigest()[:12]
+
+        #read the donors row by row straight into the database
+        return write_donors(iter_crf_xlsb(xlsb_file), db=db,
+                            version=version, source=url)
+    finally:
+        os.remove(xlsb_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+'''
+Resolve HLA allele names to G groups using hla_ambigs.json
+(made by hla_g_groups2json.py)
+
+Every allele is indexed to its G group(s), and a field level prefix tree
+answers partial names: 'A*02' -> every G group with an A*02 allele,
+'A*02:01' -> every G group with an A*02:01 allele, in time proportional
+to the number of fields of the name. A snapshot of the indexes (plain
+json data, the prefix tree as flat lists) can be saved and loaded faster
+than rebuilding them from hla_ambigs.json.
+'''
+
+import os
+import re
+import json
+
+#change this when the layout of the snapshot changes
+SNAPSHOT_FORMAT = 2
+
+#a field of an allele name with its optional expression suffix e.g. '02N'
+FIELD = re.compile(r'^(\d+)([A-Z]*)$')
+
+
+def allele_fields(allele: str):
+    '''
+    split an allele name into locus and fields, dropping the 'HLA-'
+    prefix and any expression suffix: 'HLA-A*01:01:01:02N' ->
+    ['A', '01', '01', '01', '02']
+    '''
+    allele = allele.strip().replace('HLA-', '')
+    locus, _, fields = allele.partition('*')
+    keys = [locus.upper()]
+    for field in fields.split(':') if fields else []:
+        match = FIELD.match(field)
+        keys.append(match[1] if match else field)
+    return keys
+
+
+class GGroupResolver:
+    '''
+    Allele to G group resolution
+
+    Parameters
+    ----------
+    ggroups : dictionary of G group: [alleles] as in hla_ambigs.json
+
+    Examples
+    --------
+    >>> resolver = load_resolver('hla_ambigs.json')
+    >>> resolver.ggroup_of('A*01:01:01:01')
+    'A*01:01:01G'
+    >>> resolver.resolve('A*02:01')
+    ['A*02:01:01G', ...]
+    >>> resolver.ggroups_under('DRB1*04')
+    [...]
+    '''
+
+    def __init__(self, ggroups: dict):
+        self.ggroups = list(ggroups)
+
+        #prefix tree: node = (children by field, G group numbers under it)
+        trie = ({}, set())
+        for n, alleles in enumerate(ggroups.values()):
+            for allele in alleles:
+                node = trie
+                for field in allele_fields(allele):
+                    node = node[0].setdefault(field, ({}, set()))
+                    node[1].add(n)
+
+        self.__index = self.__make_index(ggroups)
+        self.__trie = self.__freeze(trie)
+        self.__alleles = {k: list(v) for k, v in ggroups.items()}
+
+
+    ###Queries###
+    def ggroup_of(self, allele: str):
+        '''
+        the G group of a full allele name, None if it is in no G group
+        '''
+        groups = self.__index.get(allele.strip().replace('HLA-', ''))
+        return self.ggroups[groups[0]] if groups else None
+
+
+    def resolve(self, allele: str):
+        '''
+        G groups of an allele name: the G group(s) of a full allele name,
+        or every G group with an allele starting with the given fields
+        (e.g. 'A*02:01') for a partial one
+        '''
+        groups = self.__index.get(allele.strip().replace('HLA-', ''))
+        if groups is None:
+            groups = self.__lookup(allele)
+        return [self.ggroups[n] for n in groups]
+
+
+    def ggroups_under(self, prefix: str):
+        '''
+        every G group with an allele under the given locus/fields
+        e.g. 'A', 'A*02', 'DRB1*04:01'
+        '''
+        return [self.ggroups[n] for n in self.__lookup(prefix)]
+
+
+    def resolve_many(self, alleles):
+        '''
+        resolve a list of allele names, each distinct name only once
+        '''
+        resolved = {}
+        for allele in alleles:
+            if allele not in resolved:
+                resolved[allele] = self.resolve(allele)
+        return [resolved[x] for x in alleles]
+
+
+    def alleles(self, ggroup: str):
+        '''
+        alleles of a G group
+        '''
+        return self.__alleles[ggroup.strip().replace('HLA-', '')]
+
+
+    ###Snapshot###
+    def save(self, snapshot_file):
+        '''
+        write a json snapshot of the resolver: the G groups, their alleles
+        and the prefix tree as flat lists in preorder (field, parent node,
+        G group numbers of each node)
+        '''
+        fields, parents, groups = [], [], []
+        stack = [('', -1, self.__trie)]
+        while stack:
+            field, parent, node = stack.pop()
+            parents.append(parent)
+            fields.append(field)
+            groups.append(node[1])
+            number = len(parents) - 1
+            stack.extend((k, number, v) for k, v in reversed(node[0].items()))
+
+        snapshot = {'format': SNAPSHOT_FORMAT,
+                    'ggroups': self.ggroups,
+                    'alleles': [self.__alleles[x] for x in self.ggroups],
+                    'fields': fields,
+                    'parents': parents,
+                    'groups': groups}
+        temp_file = snapshot_file + '.tmp'
+        with open(temp_file, 'w') as fout:
+            json.dump(snapshot, fout, separators=(',', ':'))
+        os.replace(temp_file, snapshot_file)
+
+
+    @classmethod
+    def load(cls, snapshot_file):
+        '''
+        read a resolver written by save, raise ValueError if the file is
+        not a snapshot of this format
+        '''
+        with open(snapshot_file, 'r') as fin:
+            snapshot = json.load(fin)
+        try:
+            if snapshot['format'] != SNAPSHOT_FORMAT:
+                raise ValueError(f"'{snapshot_file}' has snapshot format "
+                                 f"{snapshot['format']}, not {SNAPSHOT_FORMAT}")
+            ggroups = dict(zip(snapshot['ggroups'], snapshot['alleles'], strict=True))
+
+            nodes = []
+            for field, parent, groups in zip(snapshot['fields'], snapshot['parents'],
+                                             snapshot['groups'], strict=True):
+                node = ({}, tuple(groups))
+                if parent >= 0:
+                    nodes[parent][0][field] = node
+                nodes.append(node)
+            trie = nodes[0]
+        except (KeyError, IndexError, TypeError) as err:
+            raise ValueError(f"'{snapshot_file}' is not a usable snapshot: {err!r}")
+
+        resolver = cls.__new__(cls)
+        resolver.ggroups = list(ggroups)
+        resolver.__index = cls.__make_index(ggroups)
+        resolver.__trie = trie
+        resolver.__alleles = ggroups
+        return resolver
+
+
+    ###Private Functions###
+    def __lookup(self, prefix: str):
+        '''
+        G group numbers under the prefix tree node of the given fields
+        '''
+        node = self.__trie
+        for field in allele_fields(prefix):
+            node = node[0].get(field)
+            if node is None:
+                return ()
+        return node[1]
+
+
+    @staticmethod
+    def __make_index(ggroups):
+        '''
+        allele (and G group name) -> sorted G group numbers
+        '''
+        index = {}
+        for n, (ggroup, alleles) in enumerate(ggroups.items()):
+            index.setdefault(ggroup, set()).add(n)
+            for allele in alleles:
+                index.setdefault(allele, set()).add(n)
+        return {k: tuple(sorted(v)) for k, v in index.items()}
+
+
+    def __freeze(self, node):
+        '''
+        turn the G group sets of the prefix tree into sorted tuples
+        '''
+        return ({k: self.__freeze(v) for k, v in node[0].items()},
+                tuple(sorted(node[1])))
+
+
+def load_resolver(json_file='hla_ambigs.json', snapshot_file=None):
+    '''
+    load the resolver from its snapshot if it is newer than json_file,
+    otherwise build it from json_file and write the snapshot
+    snapshot_file defaults to json_file with a '.resolver' extension
+    '''
+    if snapshot_file is None:
+        snapshot_file = os.path.splitext(json_file)[0] + '.resolver'
+
+    if os.path.exists(snapshot_file) and \
+            os.path.getmtime(snapshot_file) >= os.path.getmtime(json_file):
+        try:
+            return GGroupResolver.load(snapshot_file)
+        except (OSError, ValueError):
+            pass
+
+    with open(json_file, 'r') as fin:
+        resolver = GGroupResolver(json.load(fin))
+
+    try:
+        resolver.save(snapshot_file)
+    except OSError as err:
+        print('Unable to write resolver snapshot:', err)
+
+    return resolver
@@ -1,11 +1,20 @@
 import xml.etree.ElementTree
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile
 import requests
 import io
+import os
 import json
+import tempfile
 
 XML_URL = 'https://github.com/ANHIG/IMGTHLA/raw/Latest/xml/hla_ambigs.xml.zip'
 
+#where the G groups sit in the ambiguity xml, as child positions:
+#ambiguityData / [1] geneList / gene (locus) / [0] gGroupsList / gGroup / allele
+GENE_LIST = 1
+LOCUS_GGROUPS = 0
+GGROUP_DEPTH = 4
+
+
 def download_ambigs_xml(url):
     '''
     download the ambiguity zipped xml from github into memory
@@ -18,54 +27,148 @@ def download_ambigs_xml(url):
     #return a file like object
     ZipFile(io.BytesIO(dl.content)).extractall()
 
-    
-def get_ggroup(ambiguities_xml_file, 
-               reverse=False, 
+
+def download_ambigs_zip(url, zip_file='hla_ambigs.xml.zip'):
+    '''
+    stream the zipped ambiguity xml from github to zip_file
+    the xml is read straight from the zip, it is not extracted
+    '''
+    fd, temp_file = tempfile.mkstemp(suffix='.zip', dir=os.path.dirname(
+                                     os.path.abspath(zip_file)))
+    try:
+        with os.fdopen(fd, 'wb') as fout, requests.get(url, stream=True) as dl:
+            dl.raise_for_status()
+            for chunk in dl.iter_content(chunk_size=1 << 16):
+                fout.write(chunk)
+        os.replace(temp_file, zip_file)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return zip_file
+
+
+def iter_ggroups(ambiguities_file):
+    '''
+    stream the G groups out of the ambiguity xml one at a time
+    ambiguities_file can be the xml file, the zipped xml (read straight
+    from the zip member) or a file like object of the xml
+    each element is cleared once processed so memory use stays flat
+    yield (G group name, [allele names]) without the 'HLA-' prefix
+    '''
+    if isinstance(ambiguities_file, (str, os.PathLike)) and \
+            is_zipfile(ambiguities_file):
+        with ZipFile(ambiguities_file) as z:
+            member = [x for x in z.namelist() if x.endswith('.xml')][0]
+            with z.open(member) as fin:
+                yield from iter_ggroups(fin)
+        return
+
+    #position of each open element among its siblings, root first
+    path = []
+    #number of children seen so far of each open element
+    children = [0]
+    #the element whose children are being streamed, cleared as we go
+    parents = []
+
+    for event, elem in xml.etree.ElementTree.iterparse(ambiguities_file,
+                                                       events=('start', 'end')):
+        if event == 'start':
+            path.append(children[-1])
+            children[-1] += 1
+            children.append(0)
+            parents.append(elem)
+            continue
+
+        children.pop()
+        parents.pop()
+        in_ggroups = (len(path) == GGROUP_DEPTH + 1 and
+                      path[1] == GENE_LIST and
+                      path[3] == LOCUS_GGROUPS)
+        if in_ggroups:
+            gGroupName = elem.attrib['name'].replace('HLA-', '')
+            alleles = [allele.attrib['name'].replace('HLA-', '')
+                       for allele in elem]
+            yield gGroupName, alleles
+        path.pop()
+
+        #drop the finished element from its parent
+        if parents and len(path) <= GGROUP_DEPTH:
+            elem.clear()
+            parents[-1].remove(elem)
+
+
+def get_ggroup(ambiguities_xml_file,
+               reverse=False,
                only_first_allele=False):
-    
-    #read the given xml file downloaded from imgt
-    #geneList   0 = releaseVersion
-    hla = xml.etree.ElementTree.parse(ambiguities_xml_file).getroot().getchildren()[1] 
-    
+    '''
+    return a dictionary of the G groups in the ambiguity xml (or zip)
+    G group: [alleles], or with only_first_allele G group: first allele
+    (first allele: G group if reverse too)
+    '''
     gGroups = {}
-    
-    #iterate through the file to get all the locus
-    for loci in hla.getchildren():
-        locus_name = loci.attrib['name']
-        #get the locus gGroup = first child element
-        locus_gGroup = loci.getchildren()[0]
-        
-        for gGroup in locus_gGroup.getchildren():
-            gGroupName = gGroup.attrib['name'].replace('HLA-', '')
-            
-            if only_first_allele:
-                firstAllele = gGroup.getchildren()[0].attrib['name'].replace('HLA-', '')
-            
-                if reverse:
-                    gGroups[firstAllele] = gGroupName
-                else:
-                    gGroups[gGroupName] = firstAllele                    
+
+    for gGroupName, alleles in iter_ggroups(ambiguities_xml_file):
+        if only_first_allele:
+            firstAllele = alleles[0]
+
+            if reverse:
+                gGroups[firstAllele] = gGroupName
             else:
-                alleles = [allele.attrib['name'].replace('HLA-', '') \
-                           for allele in gGroup.getchildren()]
-                gGroups[gGroupName] = alleles
-        
+                gGroups[gGroupName] = firstAllele
+        else:
+            gGroups[gGroupName] = alleles
+
     return gGroups
 
-def write_to_json(json_file):
+
+def write_json_files(ambiguities_file, ggroups_json='hla_ambigs.json',
+                     first_allele_json=None, reverse_json=None):
+    '''
+    write the G groups of the ambiguity xml (or zip) in a single pass:
+        ggroups_json      : G group: [alleles]
+        first_allele_json : G group: first allele (optional)
+        reverse_json      : first allele: G group (optional)
+    each entry is written as soon as its G group has been read
+    return the number of G groups
+    '''
+    outputs = [(ggroups_json, lambda g, a: (g, a)),
+               (first_allele_json, lambda g, a: (g, a[0])),
+               (reverse_json, lambda g, a: (a[0], g))]
+    outputs = [(open(f, 'w'), entry) for f, entry in outputs if f]
+
+    count = 0
+    try:
+        for fout, _ in outputs:
+            fout.write('{')
+        for gGroupName, alleles in iter_ggroups(ambiguities_file):
+            for fout, entry in outputs:
+                key, value = entry(gGroupName, alleles)
+                fout.write('{}{}: {}'.format(', ' if count else '',
+                                             json.dumps(key),
+                                             json.dumps(value)))
+            count += 1
+        for fout, _ in outputs:
+            fout.write('}')
+    finally:
+        for fout, _ in outputs:
+            fout.close()
+
+    return count
+
+
+def write_to_json(json_file, ambiguities_file='hla_ambigs.xml'):
     '''
     make a json file for hla_ambigs.xml only keeping the G groups
     '''
-    with open('hla_ambigs.json', 'w') as fout:
-        fout.write(json.dumps(get_ggroup('hla_ambigs.xml')))
+    write_json_files(ambiguities_file, ggroups_json=json_file)
+
+
 
-        
-        
 if __name__ == '__main__':
     #download
     print('\n\tDownloading the latest HLA amibiguity list xml file from Github...')
-    download_ambigs_xml(XML_URL)
+    zip_file = download_ambigs_zip(XML_URL)
     print('\n\tConverting the list to json...')
-    #write to a local json file
-    write_to_json('hla_ambigs.json')
-    print('\n\thla_ambig.json has been updated to the latest version...\n')
\ No newline at end of file
+    #write to a local json file straight from the zip
+    write_json_files(zip_file, ggroups_json='hla_ambigs.json')
+    print('\n\thla_ambig.json has been updated to the latest version...\n')
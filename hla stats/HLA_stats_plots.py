@@ -1,14 +1,154 @@
-from collections import Counter
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import requests
 
+#where downloaded sources are kept between runs
+CACHE_DIR = '.hla_stats_cache'
+#validators of the cached sources, kept in CACHE_DIR
+CACHE_INDEX = 'index.json'
+
+
+def is_url(url_or_file):
+    return url_or_file.startswith(('http://', 'https://'))
+
+
+class SourceCache():
+    '''
+    Fetch-through disk cache of the remote sources of the plots
+
+    Each url is downloaded once into cache_dir together with its
+    ETag/Last-Modified validators; later runs only send a conditional
+    request and keep the cached copy if it has not changed. Within one
+    SourceCache a url is checked at most once. With offline=True the
+    network is never used and only cached copies are served.
+
+    Parameters
+    ----------
+    cache_dir : directory of the cached copies
+    offline   : serve from the cache only
+    timeout   : seconds to wait for the server
+    '''
+    def __init__(self, cache_dir=CACHE_DIR, offline=False, timeout=60):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.timeout = timeout
+        self.__checked = set()
+
+
+    def fetch(self, url_or_file):
+        '''
+        local path of url_or_file, downloading it only if the cached copy
+        is missing or out of date; local files are returned unchanged
+        '''
+        if not is_url(url_or_file):
+            return url_or_file
+
+        url = url_or_file
+        index = self.__read_index()
+        entry = index.get(url)
+        path = os.path.join(self.cache_dir, self.__file_name(url))
+        cached = entry is not None and os.path.exists(path)
+
+        if cached and (self.offline or url in self.__checked):
+            return path
+        if self.offline:
+            raise FileNotFoundError(f'{url} is not cached in {self.cache_dir} '
+                                    '- unable to read it offline')
+
+        headers = {}
+        if cached:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with requests.get(url, headers=headers, stream=True,
+                          timeout=self.timeout) as r:
+            if r.status_code == 304 and cached:
+                self.__checked.add(url)
+                return path
+            r.raise_for_status()
+            print(f'Downloading {url}...')
+            self.__write(r, path)
+            entry = {'file': os.path.basename(path),
+                     'etag': r.headers.get('ETag'),
+                     'last_modified': r.headers.get('Last-Modified')}
+
+        #re-read in case another run has updated the index meanwhile
+        index = self.__read_index()
+        index[url] = entry
+        self.__write_index(index)
+        self.__checked.add(url)
+        return path
+
+
+    def clear(self):
+        '''
+        remove every cached copy
+        '''
+        for entry in self.__read_index().values():
+            path = os.path.join(self.cache_dir, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+        self.__write_index({})
+        self.__checked.clear()
+
+
+    ###Private Functions###
+    def __file_name(self, url):
+        '''
+        cached file name of url: a hash of it keeping its extension
+        '''
+        extension = os.path.splitext(url.split('?')[0])[1][:8]
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + extension
+
+
+    def __write(self, response, path):
+        '''
+        stream the response body next to path then swap it in
+        '''
+        fd, temp_file = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    fout.write(chunk)
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, path)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+
+    def __read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, CACHE_INDEX), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def __write_index(self, index):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        index_file = os.path.join(self.cache_dir, CACHE_INDEX)
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(index_file + '.tmp', index_file)
+
+
 class DataGrowthPlot():
     '''
     Plot the data growth stats from EBI/IMGT/HLA
+    the page is read through cache (a SourceCache, default one in CACHE_DIR)
     '''
-    def __init__(self, url):
-        stats = pd.read_html(url, parse_dates=True)
+    def __init__(self, url, cache=None):
+        cache = SourceCache() if cache is None else cache
+        stats = pd.read_html(cache.fetch(url), parse_dates=True)
         if stats[1].iloc[0, 0] != 'Database Growth':
             raise Exception('The page layout of {url} has changed - unable to parse data.')
         else:
@@ -102,90 +242,45 @@ class LocusStackingPlot():
     '''
     Plot the 'Allelelist_history.txt' file of the latest release
     '''
-    def __init__(self, url_or_text_file, version_to_date_map=None):
-        if 'http' in url_or_text_file:
-            print('Reading directly from url may take a while...')
-        
+    def __init__(self, url_or_text_file, version_to_date_map=None, cache=None):
+        #download once (or reuse the cached copy) for both header and data
+        cache = SourceCache() if cache is None else cache
+        text_file = cache.fetch(url_or_text_file)
+
         header_line, separator = \
-            self.__get_history_file_header_type(url_or_text_file)
+            self.__get_history_file_header_type(text_file)
         
         #read in the data
-        d = pd.read_csv(url_or_text_file,
+        d = pd.read_csv(text_file,
                         sep=separator,                        
                         skiprows=header_line,
                         index_col='HLA_ID',
                         dtype=str)
-        
 
-        #fill the gaps with empty strings
-        d.fillna('', inplace=True)
-        #keep only the locus names
-        d = d.applymap(lambda x: x.split('*')[0].replace('w', ''))
+        #count each locus in each release
+        self.__stats = count_alleles_by_locus(d, version_to_date_map)
 
-        #if a conversion mapping is available
-        if  version_to_date_map is None:
-            #don't do any conversion
-            f = lambda x:x 
-        else:
-            #lambda to convert version numbers
-            # e.g. 3310 -> 3.31, 1050 -> 1.5 etc.
-            f = lambda x: version_to_date_map['.'.join( \
-                                               [x[0], str(int(x[1:3]))]) \
-                                             ]
-            
 
-        #count each locus
-        c = d.apply(lambda x: Counter(x))
-
-        #convert c to dataframe and label according to version_to_date_map
-        new_d = pd.DataFrame()
-
-        for value in c.index[::-1]:
-            new_index = f(value)
-            new_d = new_d.append(pd.DataFrame(c.loc[value], index=[new_index]))
-
-        self.__stats = new_d
-
-
-    def __get_history_file_header_type(self, url_or_file):
+    def __get_history_file_header_type(self, text_file):
         '''
         function to find where the file really starts
         after release 3.32 the allele hisotry file changes
         from tsv to csv with meta information on top
         '''
-        header = self.__read_header(url_or_file)
+        header = self.__read_header(text_file)
         for n, line in enumerate(header):
             if 'HLA_ID' in line:
                 return n, line[len('HLA_ID'):len('HLA_ID')+1]
     
     
-    def __read_header(self, url_or_file):
-        if 'http://' in url_or_file or 'https://' in url_or_file:
-            return self.__read_header_from_url(url_or_file)
-        else:
-            return self.__read_header_from_file(url_or_file)
-                
-    
-    
-    
-    def __read_header_from_file(self, file_name):
+    def __read_header(self, file_name):
         '''
         helper function read the first 100 lines from 
         allele history text file
         ''' 
         with open(file_name, 'r') as f:
-            hundred_lines = f.readlines()[:100]
+            hundred_lines = [line for _, line in zip(range(100), f)]
         return hundred_lines        
-    
-    
-    def __read_header_from_url(self, url):
-        '''
-        helper function read the first 100 lines from
-        allele history text file URL
-        '''
-        with requests.get(url) as r:
-            hundred_lines = r.text.splitlines()[:100]
-        return hundred_lines
 
     
     def plot(self, to_file='Allele_growth_by_locus.png', savefig=False):
@@ -219,3 +314,40 @@ class LocusStackingPlot():
                        ))
         if savefig:
             plt.savefig(to_file)
+
+
+
+def count_alleles_by_locus(history, version_to_date_map=None):
+    '''
+    count the alleles of each locus in every release of the allele history
+    table (one column per release, latest first, allele names or blanks)
+    return a dataframe with one row per release (oldest first) and one
+    column per locus; release labels are converted with
+    version_to_date_map if given (e.g. 3310 -> map['3.31'])
+    '''
+    values = history.to_numpy(dtype=object)
+    n_rows, n_releases = values.shape
+
+    #work out the locus of each distinct allele name only once
+    #e.g. 'Cw*01:02' -> 'C', blank cells are coded -1
+    codes, names = pd.factorize(values.ravel(order='F'))
+    loci = pd.Series(names, dtype=object).str.split('*', n=1).str[0] \
+                                         .str.replace('w', '', regex=False)
+    locus_codes, locus_names = pd.factorize(loci)
+
+    #count (release, locus) pairs in one go
+    kept = codes >= 0
+    release = np.repeat(np.arange(n_releases), n_rows)[kept]
+    locus = locus_codes[codes[kept]]
+    counts = np.bincount(release * len(locus_names) + locus,
+                         minlength=n_releases * len(locus_names))
+
+    releases = history.columns[::-1]
+    if version_to_date_map is not None:
+        #convert version numbers e.g. 3310 -> 3.31, 1050 -> 1.5 etc.
+        releases = [version_to_date_map['.'.join([x[0], str(int(x[1:3]))])]
+                    for x in releases]
+
+    counts = counts.reshape(n_releases, len(locus_names))[::-1]
+    return pd.DataFrame(counts, index=list(releases),
+                        columns=list(locus_names))
@@ -1,33 +1,148 @@
 '''
 Download the latest protein alignment files from Github
+
+Files are fetched concurrently over one pooled session. The url, ETag and
+Last-Modified headers of every downloaded file are kept in a manifest
+next to the files so later runs from the same url only send conditional
+requests and nothing is transferred for files that have not changed.
 '''
 import os
-from requests import request
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
 
 GIT_URL = 'https://raw.githubusercontent.com/ANHIG/IMGTHLA/Latest/alignments/'
 
 HLA_LOCI = ['A','B','C','ClassI','DMA','DMB','DOA','DOB','DPA1','DPB1','DQA1', 
             'DQB1','DRA','DRB','E','F','G','HFE','MICA','MICB','TAP1','TAP2']
 
-def download_latest_prot_alignments(locus_list, output_path='.'):
+#sidecar file with the validators of the downloaded files
+MANIFEST = '.download_manifest.json'
+
+#download status of each file
+DOWNLOADED = 'downloaded'
+NOT_MODIFIED = 'not modified'
+FAILED = 'failed'
+
+
+def download_latest_prot_alignments(locus_list, output_path='.',
+                                    base_url=GIT_URL, max_workers=8,
+                                    timeout=60):
+    '''
+    download the protein alignment files of the given loci into output_path
+    (created if it does not exist)
+    return a dictionary of file name: (status, detail)
+    status is one of DOWNLOADED, NOT_MODIFIED or FAILED
+    '''
     prot_files = ['{}_prot.txt'.format(locus) for locus in locus_list]
-    
-    success_count = 0
-    
-    total_count = len(prot_files)
-    
-    for file in prot_files:
-        try:
-            r = request('GET', GIT_URL + file)
-            with open(os.path.join(output_path, file), 'w') as fout:
-                fout.write(r.text)
-                
-            success_count += 1
-        except:
-            pass
-
-    print('{}/{} files downloaded successfully.'.format(success_count, 
-                                                       total_count))
+
+    os.makedirs(output_path, exist_ok=True)
+    manifest = read_manifest(output_path)
+
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = pool.map(lambda file: download_file(session,
+                                                          base_url + file,
+                                                          output_path,
+                                                          file,
+                                                          manifest.get(file),
+                                                          timeout),
+                               prot_files)
+            results = list(results)
+
+    report = {}
+    for file, (status, detail, validators) in zip(prot_files, results):
+        report[file] = (status, detail)
+        if status == DOWNLOADED:
+            manifest[file] = validators
+
+    write_manifest(output_path, manifest)
+
+    success_count = sum(1 for status, _ in report.values() if status != FAILED)
+    print('{}/{} files up to date ({} downloaded).'.format(
+          success_count, len(prot_files),
+          sum(1 for status, _ in report.values() if status == DOWNLOADED)))
+    for file, (status, detail) in report.items():
+        if status == FAILED:
+            print('{}: {}'.format(file, detail))
+
+    return report
+
+
+def download_file(session, url, output_path, file, validators=None, timeout=60):
+    '''
+    conditionally download url to output_path/file
+    the body is streamed into a temporary file which then replaces the
+    target, so an interrupted download never leaves a partial file
+    return (status, detail, validators of the downloaded file)
+    '''
+    target = os.path.join(output_path, file)
+
+    headers = {}
+    #only ask for changes if we still have the file the validators belong to
+    #and it came from the same url (base_url may point at another server)
+    if validators and validators.get('url') == url and os.path.exists(target):
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    try:
+        with session.get(url, headers=headers, stream=True,
+                         timeout=timeout) as r:
+            if r.status_code == 304:
+                return NOT_MODIFIED, '', validators
+            r.raise_for_status()
+
+            fd, temp_file = tempfile.mkstemp(dir=output_path, suffix='.part')
+            try:
+                os.chmod(temp_file, 0o644)
+                size = 0
+                with os.fdopen(fd, 'wb') as fout:
+                    for chunk in r.iter_content(chunk_size=1 << 16):
+                        fout.write(chunk)
+                        size += len(chunk)
+                os.replace(temp_file, target)
+            except BaseException:
+                os.remove(temp_file)
+                raise
+
+            return (DOWNLOADED,
+                    '{} bytes'.format(size),
+                    {'url': url,
+                     'etag': r.headers.get('ETag'),
+                     'last_modified': r.headers.get('Last-Modified')})
+
+    except (requests.RequestException, OSError) as err:
+        return FAILED, str(err), validators
+
+
+def read_manifest(output_path):
+    '''
+    read the validators of previously downloaded files
+    '''
+    try:
+        with open(os.path.join(output_path, MANIFEST), 'r') as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(output_path, manifest):
+    '''
+    atomically write the validators of the downloaded files
+    '''
+    fd, temp_file = tempfile.mkstemp(dir=output_path, suffix='.part')
+    os.chmod(temp_file, 0o644)
+    with os.fdopen(fd, 'w') as fout:
+        json.dump(manifest, fout, indent=1, sort_keys=True)
+    os.replace(temp_file, os.path.join(output_path, MANIFEST))
                                                        
 
 if __name__ == '__main__':
@@ -1,8 +1,17 @@
 import re
 import os
-from collections import Iterable
+import json
+import shutil
+import hashlib
+import contextlib
+import tempfile
+from collections import OrderedDict
+from collections.abc import Iterable
 from datetime import datetime
-import pandas as pd
+import numpy as np
+#pandas (and the process pool) are only imported where they are used
+#(to_frame, aligned, unique_seq etc.), parsing and the encoded alignment
+#only need numpy so the module loads quickly in short lived processes
 
 '''
 This module processes and parses the IMGT HLA protein alignments
@@ -57,6 +66,314 @@ WIDTHS = {'ALLELE':18, 'SEQ':122}
 #suffixes for Null/Question?/Secreted proteins
 EXPRESSION_EXCLUSION = 'NQS'
 
+#an HLA allele like string with an optional Null/Question?/Secreted suffix
+LOOKS_LIKE_HLA = re.compile(r'(\w+\*\d{{2,3}}.*:\d{{2,3}})([{}]?)'.format(
+                            EXPRESSION_EXCLUSION))
+
+#protein alignment file names on IMGT are e.g. 'DPB1_prot.txt'
+ALIGNMENT_SUFFIX = '_prot.txt'
+
+#bump this whenever the layout of the saved/cached parsed alignment changes
+CACHE_FORMAT = 3
+
+#files making up a saved parsed alignment (see save_encoded)
+SAVED_FILES = {'RESIDUES' : 'residues.npy',
+               'POSITIONS' : 'positions.npy',
+               'INFO' : 'alignment.json'}
+
+#residues are stored as their ASCII codes in the encoded alignment
+#positions past the end of a shorter sequence are padded with 0
+#'-' (same as the reference) is replaced by the reference residue,
+#'.' (insertion/deletion gap) and '*' (unknown) are real symbols of the
+#allele and are kept as they are
+PADDING = 0
+SAME_AS_REF = ord('-')
+GAP = ord('.')
+UNKNOWN = ord('*')
+
+#one letter string of every residue code, None for padding, so decoding
+#is a single lookup of the codes
+DECODED_RESIDUES = np.array([None] + [chr(x) for x in range(1, 256)],
+                            dtype=object)
+
+#alleles (rows) compared with all of the others at a time by distance_matrix
+DISTANCE_BLOCK = 1024
+
+#views (difference mask, '-' display and dataframes) kept per alignment
+#for the most recently used references
+REFERENCE_CACHE = 4
+
+#alleles read from the file at a time by iter_alleles
+STREAM_BUFFER = 1000
+
+
+class Encoded_Alignment:
+    '''
+    Compact HLA protein alignment: one row per allele, one column per
+    amino acid position, each residue stored as a uint8 (ASCII) code.
+    A fraction of the memory of the equivalent pandas dataframe and
+    positions can be compared with vectorised numpy operations.
+
+    Parameters
+    ----------
+    residues  : 2-D numpy uint8 array (alleles x positions)
+    alleles   : allele names, one per row of residues
+    positions : amino acid position labels, one per column of residues
+
+    Examples
+    --------
+    >>> enc = Protein_Alignment('DPB1 Prot.txt').encoded
+    >>> row = enc.allele_index('DPB1*04:01:01:01')
+    >>> enc.residues[row, enc.position_index([57, 65])].tobytes()
+    b'EL'
+    >>> enc.to_frame()
+    ...
+    '''
+
+    def __init__(self, residues, alleles, positions):
+        self.residues = np.asarray(residues, dtype=np.uint8)
+        self.alleles = list(alleles)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        if self.residues.shape != (len(self.alleles), len(self.positions)):
+            raise ValueError('residues shape {} does not match {} alleles x '
+                             '{} positions'.format(self.residues.shape,
+                                                   len(self.alleles),
+                                                   len(self.positions)))
+        self.__rows = {allele: n for n, allele in enumerate(self.alleles)}
+        self.__columns = {position: n for n, position in
+                          enumerate(self.positions.tolist())}
+        #views of the alignment against each reference row, most recently
+        #used last
+        self.__references = OrderedDict()
+
+
+    def __len__(self):
+        return len(self.alleles)
+
+
+    def allele_index(self, alleles):
+        '''
+        row number(s) of the given allele name or list of allele names
+        '''
+        if isinstance(alleles, str):
+            return self.__rows[alleles]
+        return np.array([self.__rows[x] for x in alleles], dtype=np.intp)
+
+
+    def position_index(self, positions):
+        '''
+        column number(s) of the given amino acid position label(s)
+        '''
+        if isinstance(positions, (int, np.integer)):
+            return self.__columns[int(positions)]
+        return np.array([self.__columns[int(x)] for x in positions],
+                        dtype=np.intp)
+
+
+    def unique(self, positions=None, rows=None):
+        '''
+        uniquefy the sequences of the given rows (default all) over the
+        given position labels (default all); each row is hashed as raw
+        bytes so no python strings are built
+        return the unique residue rows in order of first appearance and,
+        for every row considered, the number of its unique sequence
+        '''
+        d = self.residues
+        if rows is not None:
+            d = d[rows]
+        if positions is not None:
+            d = d[:, self.position_index(positions)]
+        d = np.ascontiguousarray(d)
+
+        if d.shape[1] == 0:
+            #no positions, every row is the same empty sequence
+            return d[:1], np.zeros(len(d), dtype=np.intp)
+
+        #view each row as a single opaque value of row-length bytes
+        keys = d.view(np.dtype((np.void, d.shape[1]))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True,
+                                      return_inverse=True)
+
+        #renumber the unique rows by first appearance
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+
+        return d[first[order]], rank[inverse.ravel()]
+
+
+    def differs_from(self, reference):
+        '''
+        boolean matrix (alleles x positions) of the residues that differ
+        from the reference allele (name or row number); padding at the
+        end of a shorter allele never differs
+        one comparison of the whole matrix against the reference row,
+        kept for the last REFERENCE_CACHE references
+        '''
+        views = self.__reference_views(reference)
+        if 'differs' not in views:
+            differs = self.residues != self.residues[views['row']]
+            differs &= self.residues != PADDING
+            differs.flags.writeable = False
+            views['differs'] = differs
+        return views['differs']
+
+
+    def relative_to(self, reference):
+        '''
+        the residues shown against the reference allele as in the IMGT
+        alignment files: '-' wherever the residue is the same as the
+        reference, the reference row itself written out in full
+        return a read only uint8 residue matrix (see decode_residues),
+        kept for the last REFERENCE_CACHE references
+        '''
+        views = self.__reference_views(reference)
+        if 'shown' not in views:
+            row = views['row']
+            shown = np.where(self.differs_from(row) | (self.residues == PADDING),
+                             self.residues, np.uint8(SAME_AS_REF))
+            shown[row] = self.residues[row]
+            shown.flags.writeable = False
+            views['shown'] = shown
+        return views['shown']
+
+
+    def relative_frame(self, reference, positions=None):
+        '''
+        relative_to as a dataframe in the layout of to_frame, limited to
+        the given position labels (default all)
+        kept for the last REFERENCE_CACHE references, so the same
+        dataframe is returned again: copy it before changing it
+        '''
+        views = self.__reference_views(reference)
+        frames = views.setdefault('frames', {})
+        key = None if positions is None else tuple(positions)
+        if key not in frames:
+            import pandas as pd
+            shown = self.relative_to(views['row'])
+            columns = self.positions
+            if key is not None:
+                index = self.position_index(key)
+                shown = shown[:, index]
+                columns = columns[index]
+            frames[key] = pd.DataFrame(data=decode_residues(shown),
+                                       index=pd.Index(self.alleles, name='allele'),
+                                       columns=columns)
+        return frames[key]
+
+
+    def __reference_views(self, reference):
+        '''
+        the cached views against a reference allele (name or row number),
+        the least recently used reference is dropped past REFERENCE_CACHE
+        '''
+        row = self.allele_index(reference) if isinstance(reference, str) \
+            else int(reference)
+
+        views = self.__references.get(row)
+        if views is None:
+            views = self.__references[row] = {'row': row}
+            while len(self.__references) > REFERENCE_CACHE:
+                self.__references.popitem(last=False)
+        else:
+            self.__references.move_to_end(row)
+        return views
+
+
+    def to_frame(self):
+        '''
+        build the pandas dataframe view of the alignment
+        padding is shown as None, as in a dataframe built from lists
+        '''
+        import pandas as pd
+        return pd.DataFrame(data=decode_residues(self.residues),
+                            index=pd.Index(self.alleles, name='allele'),
+                            columns=self.positions)
+
+
+    def distances(self, alleles=None, other_alleles=None, positions=None,
+                  **kwargs):
+        '''
+        amino acid mismatch counts between alleles, see distance_matrix
+        '''
+        return distance_matrix(self, alleles=alleles,
+                               other_alleles=other_alleles,
+                               positions=positions, **kwargs)
+
+
+def decode_residues(residues):
+    '''
+    convert a uint8 residue array to an object array of one letter strings
+    padding becomes None
+    '''
+    return DECODED_RESIDUES[np.asarray(residues, dtype=np.uint8)]
+
+
+def save_encoded(path, encoded, meta=None):
+    '''
+    save an Encoded_Alignment (and the meta data) into the directory path:
+    the residue matrix and positions as .npy files, the allele names and
+    meta data as json. The directory is written next to path first and
+    then moved into place, so readers never see a half written alignment
+    '''
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+
+    meta = dict(meta or {})
+    if isinstance(meta.get('DATE'), datetime):
+        meta['DATE'] = meta['DATE'].isoformat()
+
+    temp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        np.save(os.path.join(temp_dir, SAVED_FILES['RESIDUES']),
+                np.ascontiguousarray(encoded.residues))
+        np.save(os.path.join(temp_dir, SAVED_FILES['POSITIONS']),
+                encoded.positions)
+        with open(os.path.join(temp_dir, SAVED_FILES['INFO']), 'w') as fout:
+            json.dump({'FORMAT' : CACHE_FORMAT,
+                       'ALLELES' : encoded.alleles,
+                       'META' : meta}, fout)
+        os.chmod(temp_dir, 0o755)
+
+        if os.path.isdir(path):
+            #swap the old copy out, processes that have it memory mapped
+            #keep reading it until they are done
+            old_dir = tempfile.mkdtemp(dir=parent, prefix='.old_')
+            os.replace(path, old_dir)
+            os.replace(temp_dir, path)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.replace(temp_dir, path)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+
+def load_encoded(path, mmap=True):
+    '''
+    load an alignment saved by save_encoded
+    with mmap = True the residue matrix is memory mapped read only, so all
+    processes loading the same alignment share one copy in the page cache
+    return the Encoded_Alignment and the meta data
+    '''
+    with open(os.path.join(path, SAVED_FILES['INFO']), 'r') as fin:
+        info = json.load(fin)
+    if info.get('FORMAT') != CACHE_FORMAT:
+        raise ValueError("'{}' was saved in an unsupported format".format(path))
+
+    residues = np.load(os.path.join(path, SAVED_FILES['RESIDUES']),
+                       mmap_mode='r' if mmap else None)
+    positions = np.load(os.path.join(path, SAVED_FILES['POSITIONS']))
+
+    meta = info['META']
+    if meta.get('DATE'):
+        meta['DATE'] = datetime.fromisoformat(meta['DATE'])
+    if meta.get('VERSION'):
+        meta['VERSION'] = tuple(meta['VERSION'])
+
+    return Encoded_Alignment(residues, info['ALLELES'], positions), meta
+
 
 class Protein_Alignment:
     '''
@@ -67,6 +384,9 @@ class Protein_Alignment:
     alignment_file      : alignment flat file (*.txt) file downloaded from IMGT
     alleles             : limit to the list of alleles to align
     ignore_non_expressed: flag to exclude alleles with sufixes defined in EXPRESSION_EXCLUSION
+    cache_dir           : optional directory to keep the parsed alignment in, so
+                          later objects/processes reading the same unchanged file
+                          with the same options do not have to parse it again
     
     Examples
     --------
@@ -76,6 +396,13 @@ class Protein_Alignment:
     >>> DP_List = ['DPB1*01:01:01:01', 'DPB1*03:01:01:01', ... 'DPB1*135:01']
     >>> some_dpb = Protein_alignment('DPB1 Prot.txt', alleles=DP_List)
     >>>
+    ...
+    >>> cached_dpb = Protein_alignment('DPB1 Prot.txt', cache_dir='.proline_cache')
+    >>>
+    ...
+    >>> all_dpb.save('DPB1_3.30.0')
+    >>> saved_dpb = Protein_Alignment.load('DPB1_3.30.0')
+    >>>
     ...  
     '''
       
@@ -84,6 +411,10 @@ class Protein_Alignment:
         #this may require more input validations
         self.__ignore_non_expressed = kwargs.get('ignore_non_expressed', False)
         self.__allele_list = kwargs.get('alleles', None)
+        self.__cache_dir = kwargs.get('cache_dir', None)
+        #the parsed alignment, filled in on first use
+        self.__encoded = None
+        self.__aligned = None
         if os.path.exists(alignment_file):
             self.__alignment_file = alignment_file
         else:
@@ -104,41 +435,198 @@ class Protein_Alignment:
     def aligned(self):
         '''
         Return the alignment as a pandas dataframe
-        Speed could potentially be an issue here as processing the alignment
-        file for all of the HLA class I proteins (Class I Prot.txt) can 
-        take up to 160s on a PC with an i5 processor
+        The alignment file is read in a single pass, so even the file
+        for all of the HLA class I proteins (ClassI_prot.txt) only takes
+        a few seconds to process
+        The file is only parsed on first access, the result is kept on the
+        object (and in cache_dir if given) and returned on later calls
+        '''
+        if self.__aligned is None:
+            self.__aligned = self.encoded.to_frame()
+        return self.__aligned
+
+
+    @property
+    def encoded(self):
+        '''
+        Return the alignment as an Encoded_Alignment (uint8 residue codes)
+        without building the pandas dataframe
         '''
-        return self.__get_alignment(self.__alignment_file)
+        if self.__encoded is None:
+            self.__encoded = self.__load_alignment()
+        return self.__encoded
     
     
     ###Public Functions###
-    def unique_seq(self, aa_range=None):
+    def save(self, path):
+        '''
+        save the parsed alignment and meta data into the directory path
+        so it can be loaded again with Protein_Alignment.load(path)
+        '''
+        save_encoded(path, self.encoded, self.meta)
+
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        load a parsed alignment saved with Protein_Alignment.save
+        without the alignment file; the residue matrix is memory mapped
+        unless mmap = False
+        '''
+        encoded, meta = load_encoded(path, mmap=mmap)
+
+        alignment = cls.__new__(cls)
+        alignment.__alignment_file = None
+        alignment.__ignore_non_expressed = False
+        alignment.__allele_list = None
+        alignment.__cache_dir = None
+        alignment.__meta_data = meta
+        alignment.__encoded = encoded
+        alignment.__aligned = None
+        return alignment
+
+
+    def unique_seq(self, aa_range=None, return_alleles=False):
         '''
         uniquefy sequeneces in the given aa_range 
         return them in a dataframe without allele indices
+        if return_alleles = True also return a list with, for each row
+        of the dataframe, the alleles sharing that sequence
+        null alleles and 'Q', and 'S' alleles are not included
+        '''
+        aa_range = self.__positions_from_range(aa_range)
+
+        enc = self.encoded
+        rows = [n for n, x in enumerate(enc.alleles)
+                if x[-1] not in EXPRESSION_EXCLUSION]
+
+        unique, inverse = enc.unique(positions=aa_range, rows=rows)
+
+        import pandas as pd
+        df = pd.DataFrame(data=decode_residues(unique),
+                          columns=aa_range if aa_range else enc.positions)
+
+        if not return_alleles:
+            return df
+
+        shared = [[] for _ in range(len(unique))]
+        for row, n in zip(rows, inverse):
+            shared[n].append(enc.alleles[row])
+
+        return df, shared
+
+
+    def relative_to(self, reference, aa_range=None):
+        '''
+        the alignment against any allele as the reference, in the same
+        dataframe layout as aligned: '-' is the same as the reference
+        switching the reference does not parse the file again, and the
+        dataframes of recent references are kept on the encoded alignment
+        (the same dataframe is returned again, copy it before changing it)
+        '''
+        aa_range = self.__positions_from_range(aa_range)
+        return self.encoded.relative_frame(reference, positions=aa_range)
+
+
+    def iter_alleles(self, buffer_size=STREAM_BUFFER):
+        '''
+        stream (allele, sequence) pairs straight from the alignment file
+        without building the alignment; '-' is replaced by the reference
+        residue as in the encoded alignment, '.' and '*' are kept
+        every allele is split over all of the blocks of the file, so the
+        alleles are read buffer_size at a time: one cursor per block is
+        moved on past the lines of those alleles, which are then complete
+        and yielded. Memory use depends on buffer_size, not on the size
+        of the file. The alleles, ignore_non_expressed options apply.
+        '''
+        if self.__alignment_file is None:
+            raise ValueError('a loaded alignment has no alignment file to '
+                             'stream, use encoded instead')
+
+        allele_end = WIDTHS['ALLELE']
+        seq_end = WIDTHS['ALLELE'] + WIDTHS['SEQ']
+
+        blocks, alleles = self.__index_blocks(self.__alignment_file)
+        order = {allele: n for n, allele in enumerate(alleles)}
+        cursors = [start for start, _ in blocks]
+        reference = None
+
+        with open(self.__alignment_file, 'rb') as fin:
+            for first in range(0, len(alleles), buffer_size):
+                last = first + buffer_size
+                chunks = {allele: [] for allele in alleles[first:last]}
+
+                for n, (_, end) in enumerate(blocks):
+                    fin.seek(cursors[n])
+                    position = cursors[n]
+                    while position < end:
+                        line = fin.readline()
+                        allele = line[:allele_end].decode('ascii', 'replace').strip()
+                        rank = order.get(allele, -1)
+                        if rank >= last:
+                            #a later allele, read with the next buffer
+                            break
+                        if 0 <= rank < first:
+                            raise ValueError("'{}' is out of order in block {} of "
+                                             "'{}'".format(allele, n + 1,
+                                                           self.__alignment_file))
+                        if allele in chunks:
+                            chunks[allele].append(
+                                line[allele_end:seq_end].rstrip(b'\r\n').replace(b' ', b''))
+                        position += len(line)
+                    cursors[n] = position
+
+                for allele, seq in chunks.items():
+                    seq = np.frombuffer(b''.join(seq), dtype=np.uint8).copy()
+                    if reference is None:
+                        reference = seq
+                    #'-' past the end of the reference is left as it is
+                    shared = seq[:len(reference)]
+                    np.copyto(shared, reference[:len(shared)],
+                              where=shared == SAME_AS_REF)
+                    yield allele, seq.tobytes().decode('ascii')
+
+
+    def distance_matrix(self, aa_range=None, alleles=None, other_alleles=None,
+                        **kwargs):
+        '''
+        number of amino acid mismatches in the given aa_range between
+        every allele of alleles and every allele of other_alleles (default
+        all of the alleles, and the same alleles), see distance_matrix
+        rows and columns follow the order of alleles and other_alleles
+        '''
+        return distance_matrix(self.encoded, alleles=alleles,
+                               other_alleles=other_alleles,
+                               positions=self.__positions_from_range(aa_range),
+                               **kwargs)
+
+    
+    ###Private Functions###  
+
+    def __positions_from_range(self, aa_range):
+        '''
+        convert aa_range to a list of position labels
+        [start, finish] covers every position in between (there is no 0)
+        a longer list is taken as the individual positions
         '''
         if not aa_range:
             #no aa range specified
-            pass
+            return None
         elif isinstance(aa_range, Iterable):
+            aa_range = list(aa_range)
             #only start and finish given
             if len(aa_range) == 2:
-                aa_range = list(range(aa_range[0], aa_range[1] + 1))
+                return [x for x in range(aa_range[0], aa_range[1] + 1)
+                        if x != 0]
             #wrong param
             elif len(aa_range) < 2:
                 raise ValueError('aa_range size < 2, please specify the start and finish of AA positions')
             #individual positions given in a list
             else:
-                pass
+                return aa_range
         else:
             raise ValueError('aa_range must be an Iterable object')
-            
-        aligned = self.__get_alignment(self.__alignment_file)
-        
-        return self.__unique_protein_seq(aligned, aa_range)
 
-    
-    ###Private Functions###  
 
     def __get_meta_data(self):
         '''
@@ -234,10 +722,7 @@ class Protein_Alignment:
         if ignore_non_expressed flag = True also exclude all of the
         unknown 'Q', secreted 'S' and null 'N' alleles defined in EXPRESSION_EXCLUSION.
         '''
-        
-        looks_like_hla = re.compile('(\w+\*\d{{2,3}}.*:\d{{2,3}})([{}]?)'.format(EXPRESSION_EXCLUSION))
-        
-        matches = looks_like_hla.search(input_string)
+        matches = LOOKS_LIKE_HLA.search(input_string)
         if matches:
             if self.__ignore_non_expressed:
                 hla_name, suffix = matches.groups()
@@ -250,98 +735,507 @@ class Protein_Alignment:
             return False
                         
 
-    def __relabel_columns(self, df: pd.DataFrame):
+    def __relabel_columns(self, length: int):
         '''
         relabel columns so position 1 of seq is the beginning amino acid of
         the mature protein, minus positions being the lead peptide
         '''
         start = self.__meta_data['PROT_START']
-        length = len(df.columns)
         columns = list(range(-start, length - start + 1))
         columns.remove(0)
         return columns
 
 
 
+    def __read_alignment_seqs(self, alignment_file):
+        '''
+        read the alignment file once, line by line, and collect the
+        sequence chunks of each allele to keep from every block.
+        alleles are returned in the order they first appear in the file
+        so the first one is always the reference seq
+        '''
+        allele_end = WIDTHS['ALLELE']
+        seq_end = WIDTHS['ALLELE'] + WIDTHS['SEQ']
+
+        kept = self.__allele_filter()
+
+        chunks = {}
+        with open(alignment_file, 'r') as fin:
+            for line in fin:
+                allele = line[:allele_end].strip()
+                if not allele or not kept(allele):
+                    continue
+                seq = line[allele_end:seq_end].rstrip('\n').replace(' ', '')
+                #dict keeps insertion order, same as groupby(sort=False)
+                chunks.setdefault(allele, []).append(seq)
+
+        #join each allele's chunks once instead of repeated concatenation
+        return {allele: ''.join(seq) for allele, seq in chunks.items()}
+
+
+    def __allele_filter(self):
+        '''
+        return a function telling if an allele (row) of the file is kept:
+        it looks like an HLA allele, passes ignore_non_expressed and is in
+        the alleles list if one was given; the reference seq (the first
+        allele kept) is always kept. Call it on the rows in file order.
+        every allele appears once per block, so each name is only
+        classified the first time it is seen
+        '''
+        #limit the number of alleles to the given list to save time
+        wanted = set(self.__allele_list) if self.__allele_list else None
+        keep = {}
+        reference = []
+
+        def kept(allele):
+            result = keep.get(allele)
+            if result is None:
+                result = self.__is_row_to_keep(allele)
+                if result and wanted is not None:
+                    if not reference:
+                        reference.append(allele)
+                    else:
+                        result = allele in wanted
+                keep[allele] = result
+            return result
+
+        return kept
+
+
+    def __index_blocks(self, alignment_file):
+        '''
+        first pass of iter_alleles: the (start, end) byte offsets of every
+        block of the file and the alleles to keep in order of appearance
+        '''
+        allele_end = WIDTHS['ALLELE']
+        kept = self.__allele_filter()
+
+        blocks = []
+        alleles = []
+        seen = set()
+        offset = 0
+        with open(alignment_file, 'rb') as fin:
+            for line in fin:
+                allele = line[:allele_end].decode('ascii', 'replace').strip()
+                if allele == 'Prot':
+                    if blocks:
+                        blocks[-1][1] = offset
+                    blocks.append([offset + len(line), None])
+                elif allele and kept(allele) and allele not in seen:
+                    seen.add(allele)
+                    alleles.append(allele)
+                offset += len(line)
+        if blocks:
+            blocks[-1][1] = offset
+
+        return blocks, alleles
+
+
+    def __cache_file(self):
+        '''
+        path of the on-disk cache for this alignment file and options
+        the key changes whenever the file is modified or replaced
+        '''
+        stat = os.stat(self.__alignment_file)
+        alleles = self.__allele_list
+        key = repr((CACHE_FORMAT,
+                    os.path.abspath(self.__alignment_file),
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                    sorted(alleles) if alleles else None,
+                    bool(self.__ignore_non_expressed)))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        name = os.path.splitext(os.path.basename(self.__alignment_file))[0]
+        return os.path.join(self.__cache_dir, '{}_{}'.format(name, digest))
+
+
+    def __load_alignment(self):
+        '''
+        return the parsed alignment from cache_dir if it is there
+        otherwise parse the alignment file and store the result
+        '''
+        if not self.__cache_dir:
+            return self.__get_alignment(self.__alignment_file)
+
+        cache_file = self.__cache_file()
+        try:
+            return load_encoded(cache_file)[0]
+        except (OSError, ValueError, KeyError):
+            #no cache yet or it is unreadable, parse it again
+            pass
+
+        encoded = self.__get_alignment(self.__alignment_file)
+
+        try:
+            save_encoded(cache_file, encoded, self.__meta_data)
+        except OSError as err:
+            print('Unable to write alignment cache:', err)
+
+        return encoded
+
+
     def __get_alignment(self, alignment_file):
-        d = pd.read_fwf(alignment_file, 
-                widths=[WIDTHS['ALLELE'], WIDTHS['SEQ']],  #total = 130 max
-                header=None,                    
-                names=['allele', 'seq'],
-                converters={'seq': lambda x: x.replace(' ', '') 
-                }
-            )
-        
-        #fill all na with specific strings so later data manipulation 
-        #can use string operations
-        d.fillna('', inplace=True)
-        
-        #filter rows to keep
-        kept_alleles = d.allele.apply(self.__is_row_to_keep)
-        d = d[kept_alleles] 
-        
-        
-        #limit the number of alleles to the given list to save time        
-        if self.__allele_list:
-            #the reference seq
-            alleles_to_process = [d['allele'].iloc[0]]
-            
-            #extend to the user specified list of seq
-            alleles_to_process.extend(self.__allele_list) 
-            
-            
-            #filter based on above list
-            d = d[d['allele'].isin(alleles_to_process)]
-        
-        
-        #amalgamate (group) all rows with the same allele name
-        # !!! sort = False !!! important, else the reference seq
-        # will be incorrect because the default sort order is
-        # alpha numeric, which means in HLA-DQB1, DQ2 is the reference
-        # instead of DQB1*05:01:01:01 in the alignment file
-        d = d.groupby('allele', sort=False).sum()
-        
-            
-        
-        #convert seq string to list
-        d['seq'] = d['seq'].apply(lambda x: list(x))
-        
-        d = pd.DataFrame(data=d['seq'].values.tolist(), # d['seq'] to list 
-                         index=d.index                  #use the same index
-                        )
-        
-        #go through each column, if a cell is '-' replace it with the ref seq
-        #this is at least 10 time faster than DataFrame.replace()
-        for col in d.columns:
-            d[col][d[col] == '-'] = d[col].iloc[0]
-        
-        d.columns = self.__relabel_columns(d)
+        seqs = self.__read_alignment_seqs(alignment_file)
+
+        #one column per amino acid position, one row per allele
+        #shorter sequences are padded at the end
+        length = max((len(x) for x in seqs.values()), default=0)
+        d = np.full((len(seqs), length), PADDING, dtype=np.uint8)
+        for row, seq in enumerate(seqs.values()):
+            d[row, :len(seq)] = np.frombuffer(seq.encode('ascii'),
+                                              dtype=np.uint8)
+
+        #replace every '-' with the ref seq residue of the same column
+        #in one pass over the whole matrix (the ref row is broadcast)
+        #a '-' opposite a '.' or '*' in the ref becomes that symbol too
+        if len(d):
+            np.copyto(d, d[0], where=(d == SAME_AS_REF))
+
+        return Encoded_Alignment(d, seqs, self.__relabel_columns(length))
+
+
+
+def load_alignments(source, loci=None, processes=None, concat=False, **kwargs):
+    '''
+    Parse several protein alignment files in parallel, one locus per
+    worker process.
+
+    Parameters
+    ----------
+    source    : a directory containing *_prot.txt files or a list of files
+    loci      : only load these loci (e.g. ['A', 'B', 'DPB1']) from source
+    processes : number of worker processes (default os.cpu_count())
+    concat    : return a single dataframe indexed by (locus, allele)
+                instead of a dict
+    kwargs    : passed on to every Protein_Alignment (alleles, cache_dir etc.)
+
+    Examples
+    --------
+    >>> alignments = load_alignments('alignments', loci=['A', 'B', 'C'])
+    >>> alignments['A'].aligned
+    ...
+    >>> all_loci = load_alignments('alignments', concat=True)
+    >>> all_loci.loc['DPB1']
+    ...
+    '''
+    if isinstance(source, str):
+        if not os.path.isdir(source):
+            raise Exception(FileNotFoundError("The directory '{}' "
+                            "cannot be found!".format(source)))
+        files = sorted(os.path.join(source, x) for x in os.listdir(source)
+                       if x.endswith(ALIGNMENT_SUFFIX))
+    else:
+        files = list(source)
+
+    alignment_files = {}
+    for file in files:
+        locus = os.path.basename(file)
+        if locus.endswith(ALIGNMENT_SUFFIX):
+            locus = locus[:-len(ALIGNMENT_SUFFIX)]
+        alignment_files[locus] = file
+
+    if loci is not None:
+        missing = [x for x in loci if x not in alignment_files]
+        if missing:
+            raise Exception(FileNotFoundError("No alignment file found for "
+                            "loci: {}".format(', '.join(missing))))
+        alignment_files = {x: alignment_files[x] for x in loci}
+
+    if processes == 1 or len(alignment_files) < 2:
+        parsed = [_parse_alignment(x, kwargs) for x in alignment_files.values()]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parsed = list(pool.map(_parse_alignment,
+                                   alignment_files.values(),
+                                   [kwargs] * len(alignment_files)))
+
+    alignments = dict(zip(alignment_files, parsed))
+
+    if concat:
+        import pandas as pd
+        return pd.concat({k: v.aligned for k, v in alignments.items()},
+                         names=['locus'])
+    return alignments
+
+
+def _parse_alignment(alignment_file, kwargs):
+    '''
+    worker for load_alignments: parse the file so the encoded alignment
+    is sent back to the parent process with the object
+    '''
+    alignment = Protein_Alignment(alignment_file, **kwargs)
+    alignment.encoded
+    return alignment
+
+
+def iter_alleles(alignment_file, buffer_size=STREAM_BUFFER, **kwargs):
+    '''
+    stream (allele, sequence) pairs from an alignment file, see
+    Protein_Alignment.iter_alleles; kwargs as for Protein_Alignment
 
+    Examples
+    --------
+    >>> for allele, seq in iter_alleles('B_prot.txt', ignore_non_expressed=True):
+    ...     print(allele, seq[:10])
+    >>> write_fasta(iter_alleles('B_prot.txt'), 'B_prot.fasta')
+    '''
+    return Protein_Alignment(alignment_file, **kwargs).iter_alleles(buffer_size)
+
+
+def write_fasta(pairs, fasta_file, aligned=False, width=60):
+    '''
+    write (allele, sequence) pairs, e.g. from iter_alleles, to a fasta
+    file (path or open file) one at a time; gaps '.' and the '-' of
+    positions past the reference are removed unless aligned = True
+    return the number of sequences written
+    '''
+    with _output(fasta_file) as fout:
+        count = 0
+        for count, (allele, seq) in enumerate(pairs, 1):
+            if not aligned:
+                seq = seq.replace('.', '').replace('-', '')
+            fout.write('>{}\n'.format(allele))
+            for n in range(0, len(seq), width):
+                fout.write(seq[n:n + width] + '\n')
+    return count
+
+
+def write_jsonl(pairs, jsonl_file):
+    '''
+    write (allele, sequence) pairs, e.g. from iter_alleles, to a json
+    lines file (path or open file): {"allele": ..., "sequence": ...}
+    return the number of sequences written
+    '''
+    with _output(jsonl_file) as fout:
+        count = 0
+        for count, (allele, seq) in enumerate(pairs, 1):
+            fout.write(json.dumps({'allele' : allele, 'sequence' : seq}) + '\n')
+    return count
+
+
+def _output(file):
+    '''
+    open a file name for writing; an open file is used as it is and
+    left open
+    '''
+    if hasattr(file, 'write'):
+        return contextlib.nullcontext(file)
+    return open(file, 'w')
+
+
+def diff_alignments(old, new):
+    '''
+    Compare two releases of the alignment of the same locus.
+
+    old and new can each be a Protein_Alignment, an Encoded_Alignment,
+    an alignment file or a directory saved with Protein_Alignment.save.
+    Residues are compared on the encoded matrices, matched by allele name
+    and position label; a position missing from one release counts as
+    padding there.
+
+    Returns a dictionary:
+        'added'     : alleles only in new
+        'removed'   : alleles only in old
+        'changed'   : {allele: [positions whose residue changed]}
+        'positions' : every position changed in at least one allele
+
+    Examples
+    --------
+    >>> changes = diff_alignments('3.30.0/A_prot.txt', '3.31.0/A_prot.txt')
+    >>> changes['added']
+    ...
+    '''
+    old = _as_encoded(old)
+    new = _as_encoded(new)
+
+    new_alleles = set(new.alleles)
+    old_alleles = set(old.alleles)
+    common = [x for x in new.alleles if x in old_alleles]
+
+    positions = np.union1d(old.positions, new.positions)
+
+    def expand(encoded):
+        #residues of the common alleles laid out on the shared positions
+        d = np.full((len(common), len(positions)), PADDING, dtype=np.uint8)
+        d[:, np.searchsorted(positions, encoded.positions)] = \
+            encoded.residues[encoded.allele_index(common)]
         return d
 
-    
-    def __unique_protein_seq(self, df, aa_range):
+    differs = expand(old) != expand(new)
+    changed_rows = np.flatnonzero(differs.any(axis=1))
+
+    return {'added' : [x for x in new.alleles if x not in old_alleles],
+            'removed' : [x for x in old.alleles if x not in new_alleles],
+            'changed' : {common[row]: positions[differs[row]].tolist()
+                         for row in changed_rows},
+            'positions' : positions[differs.any(axis=0)].tolist()}
+
+
+def distance_matrix(alignment, alleles=None, other_alleles=None,
+                    positions=None, block_size=DISTANCE_BLOCK, processes=None,
+                    out=None):
+    '''
+    Hamming distance (number of amino acid mismatches) between alleles.
+
+    Parameters
+    ----------
+    alignment     : a Protein_Alignment, Encoded_Alignment, alignment file
+                    or saved alignment directory
+    alleles       : allele names or row numbers (default every allele)
+    other_alleles : allele names or row numbers to compare alleles with
+                    (default the same as alleles: all pairs)
+    positions     : position labels, or a boolean mask of the positions,
+                    to compare (default every position)
+    block_size    : number of alleles compared with all of other_alleles
+                    at a time, which bounds the memory used
+    processes     : spread the blocks over this many worker processes
+    out           : .npy file to write the matrix to as it is calculated
+                    (returned memory mapped) instead of keeping it in memory
+
+    A position counts as a mismatch if both alleles have a residue there
+    and the residues differ; a gap '.' against a residue is a mismatch,
+    padding and unknown '*' residues are never counted. Each block is a
+    single matrix product of one-hot residue encodings: (both known)
+    minus (both the same residue) summed over positions.
+
+    Returns a uint16 matrix of len(alleles) x len(other_alleles)
+
+    Examples
+    --------
+    >>> hla_b = Protein_Alignment('B_prot.txt')
+    >>> d = distance_matrix(hla_b, positions=range(1, 183), processes=8,
+    ...                     out='B_distances.npy')
+    '''
+    encoded = _as_encoded(alignment)
+
+    left = _rows_of(encoded, alleles)
+    right = left if other_alleles is None else _rows_of(encoded, other_alleles)
+
+    if positions is None:
+        columns = slice(None)
+    else:
+        positions = np.asarray(list(positions))
+        columns = (np.flatnonzero(positions) if positions.dtype == bool
+                   else encoded.position_index(positions))
+
+    job = _Distance_Job(encoded.residues[left][:, columns],
+                        encoded.residues[right][:, columns])
+    shape = (len(left), len(right))
+
+    if out is None:
+        distances = np.empty(shape, dtype=np.uint16)
+    else:
+        distances = np.lib.format.open_memmap(out, mode='w+',
+                                              dtype=np.uint16, shape=shape)
+
+    starts = range(0, shape[0], block_size)
+    if processes is None or processes < 2 or len(starts) < 2:
+        for start in starts:
+            distances[start:start + block_size] = job.block(start, block_size)
+    else:
+        #workers write their blocks straight into the output file
+        if out is not None:
+            distances.flush()
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_set_distance_job,
+                                 initargs=(job, out)) as pool:
+            for start, block in zip(starts, pool.map(_distance_block, starts,
+                                                     [block_size] * len(starts))):
+                if block is not None:
+                    distances[start:start + block_size] = block
+
+    if out is not None:
+        distances.flush()
+    return distances
+
+
+class _Distance_Job:
+    '''
+    the alleles of distance_matrix as one-hot residue features:
+    a column per position for 'has a residue' and a column per residue
+    seen at each position among the other alleles
+    '''
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.__right_features = None
+
+        known = self.__known(right)
+        self.columns, self.codes = [], []
+        for code in np.unique(right[known]) if right.size else []:
+            columns = np.flatnonzero((right == code).any(axis=0))
+            self.columns.append(columns)
+            self.codes.append(np.full(len(columns), code, dtype=np.uint8))
+        self.columns = np.concatenate(self.columns or [np.zeros(0, np.intp)])
+        self.codes = np.concatenate(self.codes or [np.zeros(0, np.uint8)])
+
+
+    def block(self, start, block_size):
         '''
-        uniquefy a given protein sequence alignment dataframe
-        return a new dataframe without allele labelling
-        but with the same column (aa position) labels
+        distances of left alleles start:start + block_size to every right one
         '''
-        if aa_range:
-            columns = aa_range
-            df = df[aa_range]
-        else:
-            columns = df.columns
-        
-        #remove null alleles and 'Q', and 'S' alleles
-        df = df.loc[[x for x in df.index if not (x[-1] in ('S', 'Q', 'N'))]]
+        if self.__right_features is None:
+            self.__right_features = self.__features(self.right, -1).T.copy()
+        left = self.__features(self.left[start:start + block_size], 1)
+        return np.rint(left @ self.__right_features).astype(np.uint16)
+
+
+    def __known(self, residues):
+        return (residues != PADDING) & (residues != UNKNOWN)
+
+
+    def __features(self, residues, sign):
+        #left [known, same] @ right [known, -same] = both known - both the same
+        known = self.__known(residues).astype(np.float32)
+        same = (residues[:, self.columns] == self.codes).astype(np.float32)
+        if sign < 0:
+            np.negative(same, out=same)
+        return np.concatenate([known, same], axis=1)
+
+
+def _set_distance_job(job, out):
+    '''
+    worker initialiser: the residues are sent once per process
+    '''
+    global _distance_job, _distance_out
+    _distance_job = job
+    _distance_out = out
 
-        #merge individual seq into a string
-        df['seq'] = df.apply(lambda x: ''.join(x), axis=1)
 
-        #uniquefy the datafame data 
-        df = pd.DataFrame([pd.Series(list(x)) for x in set(df['seq'])])
+def _distance_block(start, block_size):
+    block = _distance_job.block(start, block_size)
+    if _distance_out is None:
+        return block
+    distances = np.load(_distance_out, mmap_mode='r+')
+    distances[start:start + block_size] = block
+    distances.flush()
+    return None
 
-        #relabelling columns
-        df.columns = columns
 
-        return df
\ No newline at end of file
+def _rows_of(encoded, alleles):
+    '''
+    row numbers of allele names or row numbers (default every row)
+    '''
+    if alleles is None:
+        return np.arange(len(encoded))
+    alleles = list(alleles)
+    if alleles and isinstance(alleles[0], str):
+        return encoded.allele_index(alleles)
+    return np.asarray(alleles, dtype=np.intp)
+
+
+def _as_encoded(alignment):
+    '''
+    the Encoded_Alignment of a Protein_Alignment, saved alignment
+    directory or alignment file
+    '''
+    if isinstance(alignment, Encoded_Alignment):
+        return alignment
+    if isinstance(alignment, Protein_Alignment):
+        return alignment.encoded
+    if os.path.isdir(alignment):
+        return load_encoded(alignment)[0]
+    return Protein_Alignment(alignment).encoded
@@ -0,0 +1,328 @@
+'''
+Inverted residue index of HLA protein alignments and OneLambda single
+antigen beads (SAB_to_alleles.json)
+
+For every (locus, position, residue) the index keeps a bitset of the beads
+and a bitset of the alleles carrying that residue, so the beads or alleles
+with a motif such as '62GE' (G at 62, E at 63) or '66K 163E' are the
+intersection of a few bitsets instead of a scan of the alignments.
+The alignments can be proline encoded alignments (Protein_Alignment or
+Encoded_Alignment) or the bead alignments of this folder (*_R3.30.0.txt).
+'''
+
+import os
+import re
+import json
+from collections import namedtuple
+import numpy as np
+
+#ASCII codes of the alignments (as proline): 0 pads, '-' same as the reference
+PADDING = 0
+SAME_AS_REF = ord('-')
+
+#only amino acid letters are indexed, not gaps '.' or unknowns '*'
+RESIDUE_CODES = np.arange(ord('A'), ord('Z') + 1, dtype=np.uint8)
+
+#bead alignment files e.g. 'HLA-DPB1_R3.30.0.txt'
+SAB_ALIGNMENT = re.compile(r'^HLA-(\w+?)_R[\d.]+\.txt$')
+
+#one part of a motif: a position followed by the residues from there on
+MOTIF_PART = re.compile(r'(-?\d+)([A-Za-z]+)')
+
+
+SAB_Alignment = namedtuple('SAB_Alignment', ['residues', 'alleles', 'positions'])
+
+
+def read_sab_alignment(alignment_file, first_position=1):
+    '''
+    read a bead alignment of this folder ('AA Pos.' header, one row per
+    allele in blocks of 10, '-' same as the first row) into the uint8
+    residue codes used by proline, '-' replaced by the reference residue
+    '''
+    alleles, sequences = [], []
+    with open(alignment_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('AA Pos'):
+                continue
+            allele, _, sequence = line.partition(' ')
+            alleles.append(allele)
+            sequences.append(sequence.replace(' ', '').encode('ascii'))
+
+    length = max(len(x) for x in sequences)
+    residues = np.zeros((len(sequences), length), dtype=np.uint8)
+    for n, sequence in enumerate(sequences):
+        residues[n, :len(sequence)] = np.frombuffer(sequence, dtype=np.uint8)
+    np.copyto(residues, residues[0], where=residues == SAME_AS_REF)
+
+    positions = np.arange(first_position, first_position + length)
+    return SAB_Alignment(residues, alleles, positions)
+
+
+def load_sab_alignments(folder='.'):
+    '''
+    read every bead alignment (HLA-<locus>_R*.txt) in folder
+    return a dictionary of locus: SAB_Alignment
+    '''
+    alignments = {}
+    for file in sorted(os.listdir(folder)):
+        match = SAB_ALIGNMENT.match(file)
+        if match:
+            alignments[match[1]] = read_sab_alignment(os.path.join(folder, file))
+    return alignments
+
+
+def parse_motif(motif):
+    '''
+    split a motif into (position, residue) pairs, residues following a
+    position are at the next positions: '62GE 163E' or '62GE+163E' ->
+    [(62, 'G', 0), (62, 'E', 1), (163, 'E', 0)] as (start, residue, offset)
+    a list of (position, residue) pairs is taken as it is
+    '''
+    if not isinstance(motif, str):
+        return [(int(position), residue.upper(), 0) for position, residue in motif]
+
+    parts = MOTIF_PART.findall(motif)
+    if not parts or MOTIF_PART.sub('', motif).strip(' +,;'):
+        raise ValueError(f"'{motif}' is not a motif e.g. '62GE' or '66K+163E'")
+    return [(int(position), residue.upper(), offset)
+            for position, residues in parts
+            for offset, residue in enumerate(residues)]
+
+
+def bits_to_numbers(bitset):
+    '''
+    numbers of the set bits of an int bitset, lowest first
+    '''
+    numbers = []
+    while bitset:
+        low = bitset & -bitset
+        numbers.append(low.bit_length() - 1)
+        bitset ^= low
+    return numbers
+
+
+class ResidueIndex:
+    '''
+    Bead and allele bitsets of every (locus, position, residue)
+
+    Parameters
+    ----------
+    alignments : dictionary of locus: alignment, each a Protein_Alignment,
+                 Encoded_Alignment or SAB_Alignment (residues, alleles, positions)
+    bead_map   : SAB_to_alleles.json as a dictionary, {group: {bead: allele}}
+                 or {bead: allele}
+
+    Beads whose allele is in none of the alignments are listed in missing.
+    A bead allele not in an alignment is matched to the allele sharing the
+    most fields with it (e.g. 'B*38:01:01:01' -> 'B*38:01:01'). Beads and
+    alleles are numbered (bit n) in the order of bead_names and allele_names.
+
+    Examples
+    --------
+    >>> index = load_index('SAB_to_alleles.json', '.')
+    >>> index.beads('66K+163E')
+    [...]
+    >>> index.alleles('62GE', loci=['A'])
+    [...]
+    >>> index.screen(['62GE', '144TKH', '76ESI'], positive_beads=['A*02:01', ...])
+    [('62GE', 3, 1), ...]
+    '''
+
+    def __init__(self, alignments: dict, bead_map: dict):
+        alignments = {locus: getattr(x, 'encoded', x)
+                      for locus, x in alignments.items()}
+        if all(isinstance(x, dict) for x in bead_map.values()):
+            bead_map = {bead: allele for group in bead_map.values()
+                        for bead, allele in group.items()}
+
+        #allele numbers are consecutive within a locus
+        self.allele_names = []
+        rows = {}
+        offsets = {}
+        for locus, alignment in alignments.items():
+            offsets[locus] = len(self.allele_names)
+            self.allele_names.extend(alignment.alleles)
+            for n, allele in enumerate(alignment.alleles):
+                rows.setdefault(allele, (locus, n))
+
+        self.bead_names = []
+        self.missing = []
+        bead_rows = {locus: ([], []) for locus in alignments}
+        for bead, allele in bead_map.items():
+            found = rows.get(allele) or self.__first_match(allele, rows)
+            if found is None:
+                self.missing.append(bead)
+                continue
+            bead_rows[found[0]][0].append(len(self.bead_names))
+            bead_rows[found[0]][1].append(found[1])
+            self.bead_names.append(bead)
+
+        self.__bead_numbers = {bead: n for n, bead in enumerate(self.bead_names)}
+        self.__positions = {}
+        self.__allele_bits = {}
+        self.__bead_bits = {}
+        self.__motifs = {}
+
+        for locus, alignment in alignments.items():
+            residues = np.asarray(alignment.residues)
+            positions = np.asarray(alignment.positions).tolist()
+            self.__positions[locus] = (positions,
+                                       {p: n for n, p in enumerate(positions)})
+            bead_numbers, allele_rows = bead_rows[locus]
+
+            for code in np.intersect1d(np.unique(residues), RESIDUE_CODES):
+                residue = chr(code)
+                has_residue = residues == code
+                for column, bits in self.__column_bitsets(has_residue,
+                                                          offsets[locus]):
+                    self.__allele_bits[(locus, positions[column], residue)] = bits
+
+                on_beads = np.zeros((len(self.bead_names), len(positions)), dtype=bool)
+                on_beads[bead_numbers] = has_residue[allele_rows]
+                for column, bits in self.__column_bitsets(on_beads):
+                    self.__bead_bits[(locus, positions[column], residue)] = bits
+
+
+    ###Queries###
+    @property
+    def loci(self):
+        return list(self.__positions)
+
+
+    def bead_bitset(self, motif, loci=None):
+        '''
+        bitset (bit n = self.bead_names[n]) of the beads carrying the motif
+        at any of loci (default every locus)
+        '''
+        key = (motif if isinstance(motif, str) else tuple(map(tuple, motif)),
+               None if loci is None else tuple(loci))
+        bits = self.__motifs.get(key)
+        if bits is None:
+            bits = self.__motif_bitset(self.__bead_bits, motif, loci)
+            self.__motifs[key] = bits
+        return bits
+
+
+    def allele_bitset(self, motif, loci=None):
+        '''
+        bitset (bit n = self.allele_names[n]) of the alleles carrying the motif
+        '''
+        return self.__motif_bitset(self.__allele_bits, motif, loci)
+
+
+    def beads(self, motif, loci=None):
+        '''
+        beads carrying the motif e.g. '62GE', '66K+163E'
+        '''
+        return [self.bead_names[n] for n in bits_to_numbers(self.bead_bitset(motif, loci))]
+
+
+    def alleles(self, motif, loci=None):
+        '''
+        alleles carrying the motif e.g. '62GE', '66K+163E'
+        '''
+        return [self.allele_names[n] for n in bits_to_numbers(self.allele_bitset(motif, loci))]
+
+
+    def residues(self, locus, position):
+        '''
+        dictionary of residue: beads at a position of a locus
+        '''
+        return {key[2]: [self.bead_names[n] for n in bits_to_numbers(bits)]
+                for key, bits in self.__bead_bits.items()
+                if key[0] == locus and key[1] == position}
+
+
+    def beads_to_bitset(self, beads):
+        '''
+        bitset of a list of bead names, e.g. the positive beads of a patient
+        '''
+        bits = 0
+        for bead in beads:
+            bits |= 1 << self.__bead_numbers[bead]
+        return bits
+
+
+    def screen(self, motifs, positive_beads, loci=None):
+        '''
+        compare each motif with a positive bead pattern
+        return (motif, positive beads with the motif, negative beads with
+        the motif) for each motif; a motif explaining the pattern well has
+        many positive and no negative beads
+        '''
+        positive = (positive_beads if isinstance(positive_beads, int)
+                    else self.beads_to_bitset(positive_beads))
+        negative = ((1 << len(self.bead_names)) - 1) & ~positive
+        screened = []
+        for motif in motifs:
+            bits = self.bead_bitset(motif, loci)
+            screened.append((motif, (bits & positive).bit_count(),
+                             (bits & negative).bit_count()))
+        return screened
+
+
+    ###Private Functions###
+    def __motif_bitset(self, bitsets, motif, loci):
+        '''
+        union over loci of the intersection of the motif residue bitsets
+        '''
+        parts = parse_motif(motif)
+        union = 0
+        for locus in self.loci if loci is None else loci:
+            if locus not in self.__positions:
+                continue
+            positions, columns = self.__positions[locus]
+            bits = -1
+            for start, residue, offset in parts:
+                column = columns.get(start)
+                if column is None or column + offset >= len(positions):
+                    bits = 0
+                    break
+                bits &= bitsets.get((locus, positions[column + offset], residue), 0)
+                if not bits:
+                    break
+            union |= bits
+        return union
+
+
+    @staticmethod
+    def __column_bitsets(matrix, offset=0):
+        '''
+        (column, int bitset of the true rows shifted by offset) of each
+        column of a boolean matrix with any true row
+        '''
+        packed = np.packbits(matrix, axis=0, bitorder='little')
+        for column in np.flatnonzero(matrix.any(axis=0)):
+            yield column, int.from_bytes(packed[:, column].tobytes(), 'little') << offset
+
+
+    @staticmethod
+    def __first_match(allele, rows):
+        '''
+        (locus, row) of the allele with the most leading fields in common
+        with allele (at least two), the first one found of those
+        '''
+        fields = allele.split(':')
+        while len(fields) >= 2:
+            name = ':'.join(fields)
+            if name in rows:
+                return rows[name]
+            for other, found in rows.items():
+                if other.startswith(name + ':'):
+                    return found
+            fields.pop()
+        return None
+
+
+def load_index(bead_map_file='SAB_to_alleles.json', alignments='.'):
+    '''
+    build the index of the beads in bead_map_file from alignments: a
+    folder of bead alignments (*_R3.30.0.txt) or a dictionary of locus:
+    alignment e.g. from proline load_alignments
+    '''
+    with open(bead_map_file, 'r') as f:
+        bead_map = json.load(f)
+    if isinstance(alignments, str):
+        alignments = load_sab_alignments(alignments)
+    return ResidueIndex(alignments, bead_map)